@@ -0,0 +1,324 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Simulate concurrent registration desks against a local database
+
+Each desk runs in its own process with its own trytond pool and
+registers candidates and applications, evaluates them and matriculates
+the admitted ones, like the desks of an admission day. The database must
+have an open admission criteria with its classes and study plan.
+
+    python benchmarks/desks.py -c trytond.conf -d akademy --desks 20
+"""
+
+import argparse
+import multiprocessing
+import random
+import subprocess
+import time
+import traceback
+from collections import defaultdict
+from datetime import date
+from decimal import Decimal
+from queue import Empty
+
+SERIALIZATION_FAILURE = '40001'
+DEADLOCK_DETECTED = '40P01'
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+def init(config_file, database):
+    from trytond.config import config
+    config.update_etc(config_file)
+    from trytond.pool import Pool
+    Pool.start()
+    pool = Pool(database)
+    pool.init()
+    return pool
+
+
+def get_setup(pool, database, criteria_id):
+    "Return the ids of the records shared by all the desks"
+    from trytond.transaction import Transaction
+
+    with Transaction().start(database, 0, readonly=True):
+        Criteria = pool.get('akademy_configuration.application.criteria')
+        Reference = pool.get('akademy_configuration.matriculation.reference')
+        Company = pool.get('company.company')
+        if criteria_id:
+            criteria = Criteria(criteria_id)
+        else:
+            criterias = Criteria.search([
+                ('phase.start', '<=', date.today()),
+                ('phase.end', '>=', date.today()),
+                ], limit=1)
+            if not criterias:
+                raise SystemExit("No admission criteria with an open phase")
+            criteria, = criterias
+        reference, = Reference.search([], limit=1)
+        company, = Company.search([], limit=1)
+        return {
+            'criteria': criteria.id,
+            'phase': criteria.phase.id,
+            'lective_year': criteria.lective_year.id,
+            'academic_level': criteria.academic_level.id,
+            'area': criteria.area.id,
+            'course': criteria.course.id,
+            'course_classe': criteria.course_classe.id,
+            'reference': reference.id,
+            'company': company.id,
+            'average': criteria.average,
+            'run': '%08x' % random.randrange(16 ** 8),
+            }
+
+
+def register(pool, setup, desk, number):
+    Party = pool.get('party.party')
+    Candidates = pool.get('akademy_matriculation.candidates')
+    Applications = pool.get('akademy_matriculation.applications')
+
+    party, = Party.create([{
+                'name': 'Run %s Desk %s Candidate %s' % (
+                    setup['run'], desk, number),
+                'is_person': True,
+                'date_birth': date(date.today().year - 17, 1, 1),
+                }])
+    candidate, = Candidates.create([{
+                'party': party.id,
+                'average': Decimal(random.randint(
+                        int(setup['average']), 20)),
+                'institution': setup['company'],
+                'academic_level': setup['academic_level'],
+                'area': setup['area'],
+                'course': setup['course'],
+                }])
+    Applications.create([{
+                'candidate': candidate.id,
+                'reference': setup['reference'],
+                'phase': setup['phase'],
+                'lective_year': setup['lective_year'],
+                'academic_level': setup['academic_level'],
+                'area': setup['area'],
+                'course': setup['course'],
+                'course_classe': setup['course_classe'],
+                }])
+
+
+def evaluate(pool, setup, desk, number):
+    Wizard = pool.get(
+        'akademy_matriculation.wizapplication_avaliation.create',
+        type='wizard')
+    session_id, _, _ = Wizard.create()
+    wizard = Wizard(session_id)
+    wizard.start.applications_criteria = setup['criteria']
+    wizard.start.incremental = True
+    wizard.transition_application_avaliation()
+    Wizard.delete(session_id)
+
+
+def matriculate(pool, setup, desk, number):
+    Result = pool.get('akademy_matriculation.applications.result')
+    Wizard = pool.get(
+        'akademy_matriculation.wizmatriculation.create', type='wizard')
+
+    results = Result.search([
+            ('application_criteria', '=', setup['criteria']),
+            ('result', '=', 'Admitido'),
+            ('application.candidate.party.name', '=',
+                'Run %s Desk %s Candidate %s' % (setup['run'], desk, number)),
+            ], limit=1)
+    if not results:
+        return
+    session_id, _, _ = Wizard.create()
+    wizard = Wizard(session_id)
+    wizard.start.is_candidate = True
+    wizard.start.is_transferred = False
+    wizard.start.applications = results[0]
+    wizard.transition_matriculation()
+    Wizard.delete(session_id)
+
+
+OPERATIONS = [
+    ('register', register),
+    ('evaluate', evaluate),
+    ('matriculate', matriculate),
+    ]
+
+
+def desk_worker(config_file, database, setup, desk, iterations, retries,
+        queue):
+    from trytond.backend import DatabaseOperationalError
+    from trytond.exceptions import UserError
+    from trytond.transaction import Transaction
+
+    # The sentinel is always sent so that main does not wait for a dead desk
+    try:
+        pool = init(config_file, database)
+        for number in range(iterations):
+            for name, operation in OPERATIONS:
+                for attempt in range(retries + 1):
+                    start = time.perf_counter()
+                    outcome = 'ok'
+                    try:
+                        with Transaction().start(database, 0, context={
+                                    'company': setup['company'],
+                                    }):
+                            operation(pool, setup, desk, number)
+                    except DatabaseOperationalError as exception:
+                        code = getattr(exception, 'pgcode', None)
+                        outcome = {
+                            SERIALIZATION_FAILURE: 'serialization',
+                            DEADLOCK_DETECTED: 'deadlock',
+                            LOCK_NOT_AVAILABLE: 'lock_timeout',
+                            }.get(code, 'operational')
+                    except UserError:
+                        outcome = 'user_error'
+                    except Exception:
+                        traceback.print_exc()
+                        outcome = 'error'
+                    queue.put((name, outcome, time.perf_counter() - start))
+                    if outcome not in {'serialization', 'deadlock',
+                            'lock_timeout', 'operational'}:
+                        break
+    except Exception:
+        traceback.print_exc()
+    finally:
+        queue.put(None)
+
+
+def lock_sampler(config_file, database, interval, stop, queue):
+    "Sample the lock requests waiting in PostgreSQL"
+    from trytond import backend
+    from trytond.transaction import Transaction
+
+    result = None
+    try:
+        init(config_file, database)
+        if backend.name != 'postgresql':
+            return
+        samples = waiting = maximum = 0
+        while not stop.is_set():
+            with Transaction().start(
+                    database, 0, readonly=True) as transaction:
+                cursor = transaction.connection.cursor()
+                cursor.execute(
+                    "SELECT COUNT(*) FROM pg_locks WHERE NOT granted")
+                count, = cursor.fetchone()
+            samples += 1
+            waiting += bool(count)
+            maximum = max(maximum, count)
+            stop.wait(interval)
+        result = (samples, waiting, maximum)
+    except Exception:
+        traceback.print_exc()
+    finally:
+        queue.put(result)
+
+
+def get(queue, processes, timeout=1):
+    "Return the next item of the queue or Empty once the processes are dead"
+    while True:
+        try:
+            return queue.get(timeout=timeout)
+        except Empty:
+            if not any(p.is_alive() for p in processes):
+                # The item may have been put just before the process ended
+                try:
+                    return queue.get(timeout=timeout)
+                except Empty:
+                    return Empty
+
+
+def percentile(values, rank):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(rank * (len(values) - 1))))]
+
+
+def report(measures, elapsed, locks):
+    print("%-12s %7s %9s %9s %9s  %s" % (
+            'operation', 'count', 'ops/s', 'p50 ms', 'p95 ms', 'outcomes'))
+    for name, _ in OPERATIONS:
+        rows = measures[name]
+        latencies = [l for o, l in rows if o == 'ok']
+        outcomes = defaultdict(int)
+        for outcome, _ in rows:
+            outcomes[outcome] += 1
+        print("%-12s %7d %9.2f %9.1f %9.1f  %s" % (
+                name, len(latencies), len(latencies) / elapsed,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.95) * 1000,
+                ', '.join('%s=%s' % i for i in sorted(outcomes.items()))))
+    if locks:
+        samples, waiting, maximum = locks
+        print("lock waits: %s of %s samples, at most %s waiting" % (
+                waiting, samples, maximum))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-c', '--config', required=True)
+    parser.add_argument('-d', '--database', required=True)
+    parser.add_argument('--desks', type=int, default=20)
+    parser.add_argument('--iterations', type=int, default=10,
+        help="candidates registered by each desk")
+    parser.add_argument('--criteria', type=int,
+        help="id of the admission criteria, the first open one by default")
+    parser.add_argument('--retries', type=int, default=3,
+        help="retries of an operation after a database conflict")
+    parser.add_argument('--lock-interval', type=float, default=0.1)
+    parser.add_argument('--update', action='store_true',
+        help="activate or update the module before the run")
+    options = parser.parse_args()
+
+    if options.update:
+        subprocess.run(['trytond-admin', '-c', options.config,
+                '-d', options.database, '-u', 'akademy_matriculation',
+                '--activate-dependencies'], check=True)
+
+    context = multiprocessing.get_context('spawn')
+    pool = init(options.config, options.database)
+    setup = get_setup(pool, options.database, options.criteria)
+
+    queue = context.Queue()
+    lock_queue = context.Queue()
+    stop = context.Event()
+    sampler = context.Process(target=lock_sampler, args=(
+            options.config, options.database, options.lock_interval, stop,
+            lock_queue))
+    sampler.start()
+
+    start = time.perf_counter()
+    desks = [context.Process(target=desk_worker, args=(
+                options.config, options.database, setup, desk,
+                options.iterations, options.retries, queue))
+        for desk in range(options.desks)]
+    for desk in desks:
+        desk.start()
+
+    measures = defaultdict(list)
+    running = len(desks)
+    while running:
+        item = get(queue, desks)
+        if item is Empty:
+            print("%s desks ended without reporting" % running)
+            break
+        if item is None:
+            running -= 1
+            continue
+        name, outcome, latency = item
+        measures[name].append((outcome, latency))
+    elapsed = time.perf_counter() - start
+    for desk in desks:
+        desk.join()
+
+    stop.set()
+    locks = get(lock_queue, [sampler])
+    if locks is Empty:
+        locks = None
+    sampler.join()
+    report(measures, elapsed, locks)
+
+
+if __name__ == '__main__':
+    main()
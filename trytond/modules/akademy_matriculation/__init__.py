@@ -6,26 +6,51 @@ from . import matriculation
 from . import configuration
 from . import party
 from . import report
+from . import reservation
+from . import batch
+from . import publication
+from . import decision
+from . import waitlist
+from . import notification
+from . import routes
+from . import ir
+
+__all__ = ['register', 'routes']
 
 def register():
     Pool.register( 
         configuration.MatriculationReference,
         configuration.ApplicationCriteria,
+        configuration.ApplicationCriteriaReference,
         configuration.LectiveYear,
         configuration.Area,
         configuration.Course,
         configuration.CourseClasse,
         configuration.AcademicLevel,
         configuration.Phase,
+        configuration.LectiveYearCloneStart,
         matriculation.Candidates, 
         matriculation.Applications,
         matriculation.ApplicationsResult,
         matriculation.StudentTransfer,
         matriculation.StudentTransferDiscipline,
+        matriculation.StudentTransferGrade,
+        matriculation.StudentTransferGradesStart,
         matriculation.MatriculationCreateWzardStart, 
         matriculation.AssociationDisciplineCreateWzardStart,
         matriculation.ApplicationAvaliationCreateWzardStart,
+        reservation.SeatReservation,
+        batch.BatchRun,
+        batch.BatchRunItem,
+        batch.BatchErrors,
+        publication.ApplicationsResultSnapshot,
+        decision.AdmissionDecision,
+        waitlist.Waitlist,
+        notification.Notification,
+        report.BatchPrintStart,
+        report.BatchPrintResult,
         party.Party,
+        ir.Cron,
 
         module='akademy_matriculation', type_='model'
     )
@@ -34,6 +59,10 @@ def register():
         matriculation.MatriculationCreateWzard,
         matriculation.AssociationDisciplineCreateWzard,
         matriculation.ApplicationAvaliationCreateWzard,
+        report.BatchPrint,
+        configuration.LectiveYearClone,
+        matriculation.CandidatesDuplicate,
+        matriculation.StudentTransferGrades,
 
         module='akademy_matriculation', type_='wizard'
     )
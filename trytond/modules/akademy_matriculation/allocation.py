@@ -0,0 +1,137 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from datetime import datetime
+
+from sql import Literal
+from sql.aggregate import Count
+
+from trytond.pool import Pool
+from trytond.tools import reduce_ids
+from trytond.transaction import Transaction
+
+
+class ClasseAllocator(object):
+    "Place students in the least-full open class"
+
+    def __init__(self, classes):
+        Classes = Pool().get('akademy_classe.classes')
+
+        # Lock the classes so that concurrent matriculations of the same
+        # classes wait for this transaction before counting the seats
+        self.classes = [c for c in classes if c.state == False]
+        if self.classes:
+            Classes.lock(self.classes)
+        self.occupancy = self.get_occupancy(self.classes)
+
+    @classmethod
+    def get_occupancy(cls, classes):
+        "Return the number of students and held seats of each classes"
+        pool = Pool()
+        ClasseStudent = pool.get('akademy_classe.classe.student')
+        SeatReservation = pool.get('akademy_matriculation.seat.reservation')
+        classe_student = ClasseStudent.__table__()
+        reservation = SeatReservation.__table__()
+        cursor = Transaction().connection.cursor()
+
+        occupancy = {c.id: 0 for c in classes}
+        if not classes:
+            return occupancy
+
+        cursor.execute(*classe_student.select(
+                classe_student.classes, Count(Literal('*')),
+                where=reduce_ids(classe_student.classes, list(occupancy)),
+                group_by=[classe_student.classes]))
+        occupancy.update(cursor)
+
+        cursor.execute(*reservation.select(
+                reservation.classes, Count(Literal('*')),
+                where=reduce_ids(reservation.classes, list(occupancy))
+                & (reservation.state == 'held')
+                & (reservation.expiration > datetime.now()),
+                group_by=[reservation.classes]))
+        for classes_id, held in cursor:
+            occupancy[classes_id] += held
+        return occupancy
+
+    @staticmethod
+    def get_free_seats(classes, occupancy):
+        "Return the free seats of the classes, unlimited without a maximum"
+        if classes.max_student is None:
+            return float('inf')
+        return classes.max_student - occupancy
+
+    def free_seats(self, classes):
+        return self.get_free_seats(classes, self.occupancy[classes.id])
+
+    @property
+    def total_free_seats(self):
+        return sum(max(self.free_seats(c), 0) for c in self.classes)
+
+    def allocate(self):
+        "Return the least-full open classes with a free seat and take it"
+        available = [c for c in self.classes if self.free_seats(c) > 0]
+        if not available:
+            return None
+
+        classes = min(available, key=lambda c: (self.occupancy[c.id], c.id))
+        self.occupancy[classes.id] += 1
+        return classes
+
+    def allocate_many(self, quantity):
+        "Return the classes of each of the quantity students to place"
+        allocations = []
+        for _ in range(quantity):
+            classes = self.allocate()
+            if classes is None:
+                break
+            allocations.append(classes)
+        return allocations
+
+
+class QuotaAllocator(object):
+    "Fill the reserved quotas of the modalities and the open seats by rank"
+
+    def __init__(self, student_limit, quotas, taken=None):
+        self.remaining = dict(quotas)
+        self.open = student_limit - sum(quotas.values())
+        # The seats already admitted count against their quota first
+        for reference, count in (taken or {}).items():
+            quota = min(count, max(self.remaining.get(reference, 0), 0))
+            if reference in self.remaining:
+                self.remaining[reference] -= quota
+            self.open -= count - quota
+
+    def allocate(self, ranked):
+        """Return the admitted of the (application, reference) by rank
+
+        Each candidate takes a seat of its quota, else an open seat. The
+        quota seats left at the end go to the best of the others.
+        """
+        admitted, deferred = set(), []
+        for application, reference in ranked:
+            if self.remaining.get(reference, 0) > 0:
+                self.remaining[reference] -= 1
+                admitted.add(application)
+            elif self.open > 0:
+                self.open -= 1
+                admitted.add(application)
+            else:
+                deferred.append(application)
+        spill = sum(self.remaining.values()) + min(self.open, 0)
+        if spill > 0:
+            admitted.update(deferred[:spill])
+        return [a for a, _ in ranked if a in admitted]
+
+
+def scale_seats(student_limit, seats, factor):
+    """Return the student limit and the reserved seats scaled by factor
+
+    The limit keeps at least one seat and the rounding of the reserved
+    seats is taken from the largest quotas when they exceed the limit.
+    """
+    limit = max(int(round(student_limit * factor)), 1)
+    seats = [max(int(round(s * factor)), 0) for s in seats]
+    while sum(seats) > limit:
+        seats[seats.index(max(seats))] -= 1
+    return limit, seats
@@ -0,0 +1,178 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+
+sel_batch_operation = [
+    ('avaliation', 'Avaliação de candidaturas'),
+    ('association', 'Associação de disciplinas'),
+]
+
+sel_batch_state = [
+    ('running', 'Em execução'),
+    ('failed', 'Falhou'),
+    ('done', 'Concluída'),
+]
+
+
+def batch_size():
+    return config.getint('akademy_matriculation', 'batch_size', default=100)
+
+
+class BatchRun(ModelSQL, ModelView):
+    'Batch Run'
+    __name__ = 'akademy_matriculation.batch.run'
+
+    operation = fields.Selection(sel_batch_operation, 'Operação',
+        required=True, readonly=True)
+    origin = fields.Reference('Origem', selection=[
+            ('akademy_configuration.application.criteria',
+                'Critério de admissão'),
+            ('akademy_classe.classes', 'Turma'),
+            ], required=True, readonly=True)
+    state = fields.Selection(sel_batch_state, 'Estado',
+        required=True, readonly=True)
+    company = fields.Many2One('company.company', 'Escola', readonly=True)
+    total = fields.Integer('Total', readonly=True)
+    processed = fields.Integer('Processados', readonly=True)
+    message = fields.Text('Mensagem', readonly=True)
+    items = fields.One2Many('akademy_matriculation.batch.run.item', 'run',
+        'Registos processados', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BatchRun, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table,
+                (table.company, Index.Equality()),
+                (table.operation, Index.Equality()),
+                (table.origin, Index.Equality()),
+                where=table.state != 'done'),
+        })
+        cls._order = [('create_date', 'DESC')]
+
+    @classmethod
+    def default_state(cls):
+        return 'running'
+
+    @classmethod
+    def default_processed(cls):
+        return 0
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def get_run(cls, operation, origin):
+        "Return the unfinished run of the operation or start a new one"
+        origin = str(origin)
+        # The run is committed apart so that it survives a failed chunk
+        with Transaction().new_transaction():
+            runs = cls.search([
+                ('company', '=', Transaction().context.get('company')),
+                ('operation', '=', operation),
+                ('origin', '=', origin),
+                ('state', '!=', 'done'),
+                ], order=[('id', 'DESC')], limit=1)
+            if runs:
+                run, = runs
+            else:
+                run, = cls.create([{
+                    'operation': operation,
+                    'origin': origin,
+                    }])
+            run_id = run.id
+        return cls(run_id)
+
+    def get_processed_ids(self):
+        RunItem = Pool().get('akademy_matriculation.batch.run.item')
+        item = RunItem.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*item.select(item.record,
+                where=item.run == self.id))
+        return {r for r, in cursor}
+
+    @classmethod
+    def execute(cls, operation, origin, ids, function):
+        """Call function on the ids by chunks committed one by one
+
+        The ids already processed by a previous run of the same operation
+        and origin are skipped. It returns the sum of the function results.
+        """
+        pool = Pool()
+        RunItem = pool.get('akademy_matriculation.batch.run.item')
+
+        run = cls.get_run(operation, origin)
+        processed = run.get_processed_ids()
+        pending = [i for i in ids if i not in processed]
+
+        result = 0
+        for sub_ids in grouped_slice(pending, batch_size()):
+            sub_ids = list(sub_ids)
+            try:
+                with Transaction().new_transaction():
+                    result += function(sub_ids) or 0
+                    RunItem.create([{
+                        'run': run.id,
+                        'record': i,
+                        } for i in sub_ids])
+                    processed.update(sub_ids)
+                    cls.write([cls(run.id)], {
+                        'total': len(ids),
+                        'processed': len(processed),
+                        })
+            except UserError as exception:
+                with Transaction().new_transaction():
+                    cls.write([cls(run.id)], {
+                        'state': 'failed',
+                        'message': exception.message,
+                        })
+                raise
+
+        with Transaction().new_transaction():
+            cls.write([cls(run.id)], {
+                'state': 'done',
+                'total': len(ids),
+                'processed': len(processed),
+                'message': None,
+                })
+        return result
+
+
+class BatchRunItem(ModelSQL):
+    'Batch Run Item'
+    __name__ = 'akademy_matriculation.batch.run.item'
+
+    run = fields.Many2One('akademy_matriculation.batch.run', 'Execução',
+        required=True, ondelete="CASCADE")
+    record = fields.Integer('Registo', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(BatchRunItem, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints = [
+            ('key', Unique(table, table.run, table.record),
+            u'O registo já foi processado nesta execução.')
+        ]
+
+
+class BatchErrors(ModelView):
+    'Batch Errors'
+    __name__ = 'akademy_matriculation.batch.errors'
+
+    processed = fields.Integer('Processados', readonly=True)
+    failed = fields.Integer('Com erros', readonly=True)
+    errors = fields.Text('Erros', readonly=True)
+
+    @staticmethod
+    def format(errors):
+        "Return the text of the errors given as (record name, message)"
+        return '\n'.join(name+": "+message for name, message in errors)
@@ -1,11 +1,38 @@
 # This file is part of SAGE Education.   The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+from sql import Literal, Null, NullsLast, Values, Window
+from sql.aggregate import Count
+from sql.conditionals import Coalesce
+from sql.functions import Extract, RowNumber
+from sql.operators import Exists
+
+from trytond.cache import Cache
 from trytond.model import ModelView, ModelSQL, fields, Unique, Check
-from trytond.pool import PoolMeta
+from trytond.pool import Pool, PoolMeta
+from trytond.rpc import RPC
 from trytond.pyson import Eval
 from trytond.exceptions import UserError
-from datetime import date
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import groupby
+
+from . import metrics, scoring
+from .allocation import QuotaAllocator, scale_seats
+from dateutil.relativedelta import relativedelta
+
+# The academic_level → area → course → course_classe hierarchy as
+# (field, model, parent field)
+CATALOGUE = [
+    ('area', 'akademy_configuration.area', 'academic_level'),
+    ('course', 'akademy_configuration.course', 'area'),
+    ('course_classe', 'akademy_configuration.course.classe', 'course'),
+]
 
 
 class MatriculationReference(ModelSQL, ModelView):
@@ -27,6 +54,43 @@ class MatriculationReference(ModelSQL, ModelView):
         ]
 
 
+class ApplicationCriteriaReference(ModelSQL, ModelView):
+    'Application Criteria Reference'
+    __name__ = 'akademy_configuration.application.criteria.reference'
+
+    criteria = fields.Many2One('akademy_configuration.application.criteria',
+        'Critério de admissão', required=True, ondelete="CASCADE")
+    reference = fields.Many2One('akademy_configuration.matriculation.reference',
+        'Modalidade de candidatura', required=True, ondelete="RESTRICT")
+    bonus = fields.Numeric('Bonificação', digits=(2,1), required=True,
+        help="Valores somados à média dos candidatos desta modalidade.")
+    seats = fields.Integer('Vagas reservadas', required=True,
+        help="Vagas reservadas aos candidatos desta modalidade.\n"
+        "As vagas não ocupadas passam para os outros candidatos.")
+
+    @classmethod
+    def __setup__(cls):
+        super(ApplicationCriteriaReference, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints = [
+            ('reference', Unique(table, table.criteria, table.reference),
+            u'Não foi possível cadastrar a modalidade, por favor verificar se a mesma já existe neste critério de admissão.'),
+            ('seats', Check(table, table.seats >= 0),
+            u'Não foi possível cadastrar a modalidade, por favor verificar se as vagas reservadas não são negativas.'),
+        ]
+
+    @classmethod
+    def default_bonus(cls):
+        return Decimal(0)
+
+    @classmethod
+    def default_seats(cls):
+        return 0
+
+    def get_rec_name(self, name):
+        return self.reference.rec_name
+
+
 class Phase(ModelSQL, ModelView):
     'Phase'
     __name__ = 'akademy_configuration.phase'
@@ -43,6 +107,10 @@ class Phase(ModelSQL, ModelView):
         'Ano letivo', required=True, ondelete="RESTRICT")
     application_criteria = fields.One2Many('akademy_configuration.application.criteria', 
         'phase', 'Critério de admissão')
+    seat_hold_days = fields.Integer('Reserva de vaga (dias)', required=True,
+        help="Dias durante os quais a vaga do candidato admitido fica reservada até à matrícula.")
+    results_published = fields.DateTime('Resultados publicados', readonly=True,
+        help="Data e hora da última publicação dos resultados da fase.")
 
     @classmethod
     def __setup__(cls):
@@ -52,13 +120,65 @@ class Phase(ModelSQL, ModelView):
             ('name', Unique(table, table.name, table.code),
             u'Não foi possível cadastrar a nova fase de admissão, por favor verificar se o nome ou código inserido já existe.'),
             ('start_date', Check(table, table.start < table.end),
-            u'Não foi possível cadastrar o novo ano letivo, por favor verificar se a data de início é menor que a data de término.')
+            u'Não foi possível cadastrar o novo ano letivo, por favor verificar se a data de início é menor que a data de término.'),
+            ('seat_hold_days', Check(table, table.seat_hold_days >= 0),
+            u'Não foi possível cadastrar a nova fase de admissão, por favor verificar os dias de reserva de vaga.')
         ]
+        cls._buttons.update({
+            'publish_results': {},
+            'rollover_applications': {},
+        })
     
     @classmethod
     def default_start(cls):
         return date.today() 
 
+    @classmethod
+    def default_seat_hold_days(cls):
+        return 7
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('akademy_configuration.application.criteria')._eligibility_cache.clear()
+        return super(Phase, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('akademy_configuration.application.criteria')._eligibility_cache.clear()
+        super(Phase, cls).write(*args)
+
+    @classmethod
+    def delete(cls, phases):
+        Pool().get('akademy_configuration.application.criteria')._eligibility_cache.clear()
+        super(Phase, cls).delete(phases)
+
+    @classmethod
+    @ModelView.button
+    def publish_results(cls, phases):
+        Snapshot = Pool().get('akademy_matriculation.applications.result.snapshot')
+        Snapshot.publish(phases)
+        cls.write(phases, {'results_published': datetime.now()})
+
+    def get_next_phase(self):
+        "Return the following phase of the same lective year"
+        phases = self.search([
+            ('lective_year', '=', self.lective_year),
+            ('start', '>', self.start),
+            ], order=[('start', 'ASC'), ('id', 'ASC')], limit=1)
+        if phases:
+            return phases[0]
+
+    @classmethod
+    @ModelView.button
+    def rollover_applications(cls, phases):
+        Applications = Pool().get('akademy_matriculation.applications')
+        for phase in phases:
+            next_phase = phase.get_next_phase()
+            if not next_phase:
+                raise UserError("Não foi possível transitar as candidaturas da fase "+phase.name+
+                    ", por favor verificar se existe uma fase seguinte no mesmo ano letivo.")
+            Applications.rollover(phase, next_phase)
+
 
 class LectiveYear(metaclass=PoolMeta):
     'Lective Year'
@@ -68,6 +188,78 @@ class LectiveYear(metaclass=PoolMeta):
         'lective_year', 'Fase de admissão')
     application_criteria = fields.One2Many('akademy_configuration.application.criteria', 
         'lective_year', 'Critério de admissão')
+    matriculation_archived = fields.Boolean('Matrículas arquivadas',
+        readonly=True,
+        help="As candidaturas, resultados e transferências do ano letivo estão arquivados.")
+
+    @classmethod
+    def __setup__(cls):
+        super(LectiveYear, cls).__setup__()
+        cls._buttons.update({
+            'archive_matriculation': {
+                'invisible': Eval('matriculation_archived', False),
+                'depends': ['matriculation_archived'],
+            },
+            'unarchive_matriculation': {
+                'invisible': ~Eval('matriculation_archived', False),
+                'depends': ['matriculation_archived'],
+            },
+        })
+
+    @classmethod
+    def default_matriculation_archived(cls):
+        return False
+
+    @classmethod
+    @ModelView.button
+    def archive_matriculation(cls, lective_years):
+        for lective_year in lective_years:
+            for phase in lective_year.phase:
+                if phase.end >= date.today():
+                    raise UserError("Não foi possível arquivar o ano letivo "+lective_year.name+
+                        ", porque a fase de admissão "+phase.name+" ainda não terminou.")
+        cls.set_matriculation_active(lective_years, False)
+        cls.write(lective_years, {'matriculation_archived': True})
+
+    @classmethod
+    @ModelView.button
+    def unarchive_matriculation(cls, lective_years):
+        cls.set_matriculation_active(lective_years, True)
+        cls.write(lective_years, {'matriculation_archived': False})
+
+    @classmethod
+    def set_matriculation_active(cls, lective_years, active):
+        "Set in bulk the active flag of the matriculation data of the years"
+        pool = Pool()
+        Candidates = pool.get('akademy_matriculation.candidates')
+        Applications = pool.get('akademy_matriculation.applications')
+        ApplicationsResult = pool.get('akademy_matriculation.applications.result')
+        StudentTransfer = pool.get('akademy_matriculation.student.transfer')
+        cursor = Transaction().connection.cursor()
+        ids = [y.id for y in lective_years]
+
+        for Model in [Applications, ApplicationsResult, StudentTransfer]:
+            table = Model.__table__()
+            cursor.execute(*table.update(
+                    [table.active], [active],
+                    where=table.lective_year.in_(ids)))
+
+        # Candidates of the years follow their applications: archived once
+        # none of them is active, restored as soon as one is
+        candidate = Candidates.__table__()
+        application = Applications.__table__()
+        year_application = application.select(application.candidate,
+            where=application.lective_year.in_(ids))
+        active_application = application.select(application.candidate,
+            where=application.active == True)
+        if active:
+            where = candidate.id.in_(active_application)
+        else:
+            where = ~candidate.id.in_(active_application)
+        cursor.execute(*candidate.update(
+                [candidate.active], [active],
+                where=candidate.id.in_(year_application) & where
+                & (candidate.active != active)))
 
 
 class AcademicLevel(metaclass=PoolMeta):
@@ -76,9 +268,76 @@ class AcademicLevel(metaclass=PoolMeta):
     
     application_criteria = fields.One2Many('akademy_configuration.application.criteria', 
         'academic_level', 'Critério de admissão')  
+    _catalogue_cache = Cache('akademy_configuration.catalogue', context=False)
 
+    @classmethod
+    def __setup__(cls):
+        super(AcademicLevel, cls).__setup__()
+        cls.__rpc__.update({
+            'get_catalogue_children': RPC(),
+        })
+
+    @classmethod
+    def get_catalogue(cls):
+        "Return the children ids of each parent for each catalogue field"
+        catalogue = cls._catalogue_cache.get('catalogue')
+        if catalogue is not None:
+            return catalogue
+
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+        catalogue = {}
+        for field, model, parent in CATALOGUE:
+            table = pool.get(model).__table__()
+            cursor.execute(*table.select(
+                    getattr(table, parent), table.id,
+                    order_by=[table.id]))
+            children = catalogue[field] = {}
+            for parent_id, child_id in cursor:
+                children.setdefault(parent_id, []).append(child_id)
+        cls._catalogue_cache.set('catalogue', catalogue)
+        return catalogue
+
+    @classmethod
+    def get_catalogue_children(cls, field, parent_id):
+        "Return the ids allowed for the catalogue field under the parent"
+        return cls.get_catalogue()[field].get(parent_id, [])
+
+    @classmethod
+    def check_catalogue(cls, records):
+        "Check in memory that the catalogue fields of records are nested"
+        catalogue = cls.get_catalogue()
+        for record in records:
+            for field, _, parent in CATALOGUE:
+                child = getattr(record, field, None)
+                parent_record = getattr(record, parent, None)
+                if not child or not parent_record:
+                    continue
+                if child.id not in catalogue[field].get(parent_record.id, []):
+                    raise UserError("Não foi possível validar o registo "+record.rec_name+
+                        ", por favor verificar se "+child.rec_name+" pertence a "+parent_record.rec_name+".")
+
+
+class CatalogueMixin(object):
+    "Clear the cached catalogue when it changes"
+
+    @classmethod
+    def create(cls, vlist):
+        Pool().get('akademy_configuration.academic.level')._catalogue_cache.clear()
+        return super(CatalogueMixin, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        Pool().get('akademy_configuration.academic.level')._catalogue_cache.clear()
+        super(CatalogueMixin, cls).write(*args)
 
-class Area(metaclass=PoolMeta):
+    @classmethod
+    def delete(cls, records):
+        Pool().get('akademy_configuration.academic.level')._catalogue_cache.clear()
+        super(CatalogueMixin, cls).delete(records)
+
+
+class Area(CatalogueMixin, metaclass=PoolMeta):
     'Area'
     __name__ ='akademy_configuration.area'
     
@@ -86,7 +345,7 @@ class Area(metaclass=PoolMeta):
         'area', 'Critério de admissão')     
 
 
-class Course(metaclass=PoolMeta):
+class Course(CatalogueMixin, metaclass=PoolMeta):
     'Course'
     __name__ ='akademy_configuration.course'
         
@@ -94,7 +353,7 @@ class Course(metaclass=PoolMeta):
         'course', 'Critério de admissão')
 
 
-class CourseClasse(metaclass=PoolMeta):
+class CourseClasse(CatalogueMixin, metaclass=PoolMeta):
     'Course Classe'
     __name__ ='akademy_configuration.course.classe'
           
@@ -116,7 +375,7 @@ class ApplicationCriteria(ModelSQL, ModelView):
     average = fields.Numeric('Média', digits=(2,1), 
         required=True, help="Informe a média mínima para admissão.")
     student_limit = fields.Integer('Total de vagas', required=True, 
-        help="Informe o limite de discentes por admitir.")
+        help="Informe o limite de discentes por admitir em cada escola.")
     lective_year = fields.Many2One('akademy_configuration.lective.year', 
         'Ano letivo', required=True, ondelete="RESTRICT")
     academic_level = fields.Many2One('akademy_configuration.academic.level', 
@@ -135,6 +394,29 @@ class ApplicationCriteria(ModelSQL, ModelView):
         'Fase', required=True, ondelete="RESTRICT")
     application_result = fields.One2Many('akademy_matriculation.applications.result', 
         'application_criteria', 'Resultado das candidaturas')
+    references = fields.One2Many(
+        'akademy_configuration.application.criteria.reference', 'criteria',
+        'Modalidades', help="Bonificação de cada modalidade de candidatura.")
+    age_threshold = fields.Integer('Idade sem penalização',
+        help="Idade a partir da qual a pontuação do candidato é penalizada.")
+    age_penalty = fields.Numeric('Penalização por ano', digits=(2,1),
+        help="Valores retirados à pontuação por cada ano acima da idade sem penalização.")
+    cut_off = fields.Function(
+        fields.Numeric('Nota de corte', digits=(4,2),
+            help="Pontuação do último candidato dentro do limite de vagas."),
+        'get_cut_off')
+    admitted_applications = fields.Function(
+        fields.One2Many('akademy_matriculation.applications', None,
+            'Candidatos admitidos',
+            help="Candidaturas classificadas dentro do limite de vagas."),
+        'get_admitted_applications')
+    remaining_seats = fields.Function(
+        fields.Integer('Vagas restantes',
+            help="Total de vagas menos os candidatos já admitidos."),
+        'get_remaining_seats')
+    _eligibility_cache = Cache(
+        'akademy_configuration.application.criteria.eligibility',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -151,10 +433,46 @@ class ApplicationCriteria(ModelSQL, ModelView):
             u'Não foi possível cadastrar o novo critério de admissão, por favor verificar se a média esta acima de 20 valores.'),
             ('student', Check(table, table.student_limit > 0),
             u'Não foi possível cadastrar o novo critério de admissão, por favor verifica o limite de vagas disponivés.'),
+            ('age_penalty', Check(table, table.age_penalty >= 0),
+            u'Não foi possível cadastrar o novo critério de admissão, por favor verifica se a penalização por idade não é negativa.'),
         ]
+        cls._buttons.update({
+            'compute_scores': {},
+        })
+
+    @classmethod
+    def validate(cls, application_criterias):
+        super(ApplicationCriteria, cls).validate(application_criterias)
+        AcademicLevel = Pool().get('akademy_configuration.academic.level')
+        AcademicLevel.check_catalogue(application_criterias)
+        for application_criteria in application_criterias:
+            if (sum(r.seats for r in application_criteria.references)
+                    > application_criteria.student_limit):
+                raise UserError("Não foi possível cadastrar o critério de admissão "+
+                    application_criteria.name+", porque as vagas reservadas excedem o total de vagas.")
+
+    @classmethod
+    def create(cls, vlist):
+        cls._eligibility_cache.clear()
+        criterias = super(ApplicationCriteria, cls).create(vlist)
+        cls.compute_scores(criterias)
+        return criterias
+
+    @classmethod
+    def write(cls, *args):
+        cls._eligibility_cache.clear()
+        super(ApplicationCriteria, cls).write(*args)
+        actions = iter(args)
+        to_score = []
+        for application_criterias, values in zip(actions, actions):
+            if values.keys() & {'references', 'age_threshold', 'age_penalty'}:
+                to_score.extend(application_criterias)
+        if to_score:
+            cls.compute_scores(to_score)
 
     @classmethod
     def delete(cls, application_criterias):
+        cls._eligibility_cache.clear()
         for application_criteria in application_criterias:        
             if len(application_criteria.application_result) < 1:
                 super(ApplicationCriteria, cls).delete(application_criteria)
@@ -165,3 +483,399 @@ class ApplicationCriteria(ModelSQL, ModelView):
     def default_student_limit(cls):
         return 0
 
+    @classmethod
+    @ModelView.button
+    def compute_scores(cls, criterias, applications=None):
+        "Score the applications of the criterias with their formula"
+        pool = Pool()
+        Applications = pool.get('akademy_matriculation.applications')
+        Candidates = pool.get('akademy_matriculation.candidates')
+        Party = pool.get('party.party')
+        criteria = cls.__table__()
+        application = Applications.__table__()
+        candidate = Candidates.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+        today = date.today()
+
+        birth = (Extract('YEAR', party.date_birth) * 10000
+            + Extract('MONTH', party.date_birth) * 100
+            + Extract('DAY', party.date_birth))
+        query = criteria.join(application, condition=(
+                (application.lective_year == criteria.lective_year)
+                & (application.academic_level == criteria.academic_level)
+                & (application.area == criteria.area)
+                & (application.course == criteria.course)
+                & (application.course_classe == criteria.course_classe)
+                & (application.phase == criteria.phase))
+            ).join(candidate, condition=application.candidate == candidate.id
+            ).join(party, condition=candidate.party == party.id)
+
+        where = Literal(True)
+        if applications is not None:
+            where = reduce_ids(application.id, list(map(int, applications)))
+        for record in criterias:
+            cursor.execute(*query.select(
+                    application.id, candidate.average, birth,
+                    application.reference,
+                    where=(criteria.id == record.id) & where))
+            rows = cursor.fetchall()
+            if not rows:
+                continue
+            ids, averages, births, references = zip(*rows)
+            scores = scoring.compute(averages, births, references,
+                bonuses={r.reference.id: r.bonus for r in record.references},
+                threshold=record.age_threshold, penalty=record.age_penalty,
+                today=today)
+            for sub_ids in grouped_slice(list(zip(ids, scores))):
+                values = Values(list(sub_ids))
+                cursor.execute(*application.update(
+                        [application.score], [values.column2],
+                        from_=[values],
+                        where=application.id == values.column1))
+
+    @classmethod
+    def ranking_query(cls, criterias):
+        "Return the query ranking the eligible applications of each criteria"
+        pool = Pool()
+        Applications = pool.get('akademy_matriculation.applications')
+        Candidates = pool.get('akademy_matriculation.candidates')
+        Party = pool.get('party.party')
+        criteria = cls.__table__()
+        application = Applications.__table__()
+        candidate = Candidates.__table__()
+        party = Party.__table__()
+
+        # A candidate is within the age limit when born after the day
+        # on which age + 1 years would be completed.
+        today = date.today()
+        birth_limit = Values([
+            [c.id, today - relativedelta(years=c.age + 1)]
+            for c in criterias])
+
+        score = Coalesce(application.score, candidate.average)
+        window = Window([criteria.id, application.company], order_by=[
+                score.desc,
+                candidate.average.desc,
+                NullsLast(party.date_birth.desc),
+                application.id.asc])
+
+        query = criteria.join(birth_limit,
+            condition=birth_limit.column1 == criteria.id
+            ).join(application, condition=(
+                (application.lective_year == criteria.lective_year)
+                & (application.academic_level == criteria.academic_level)
+                & (application.area == criteria.area)
+                & (application.course == criteria.course)
+                & (application.course_classe == criteria.course_classe)
+                & (application.phase == criteria.phase))
+            ).join(candidate, condition=application.candidate == candidate.id
+            ).join(party, condition=candidate.party == party.id)
+        where = ((candidate.average >= criteria.average)
+            & ((party.date_birth == Null)
+                | (party.date_birth > birth_limit.column2)))
+        company = Transaction().context.get('company')
+        if company:
+            where &= application.company == company
+        return query.select(
+            criteria.id.as_('criteria'),
+            criteria.student_limit.as_('student_limit'),
+            application.id.as_('application'),
+            application.company.as_('company'),
+            application.reference.as_('reference'),
+            candidate.average.as_('average'),
+            score.as_('score'),
+            RowNumber(window=window).as_('rank'),
+            where=where)
+
+    @classmethod
+    def get_ranking(cls, criterias):
+        "Return the ids of the eligible applications of each criteria by rank"
+        cursor = Transaction().connection.cursor()
+        ranking = {c.id: [] for c in criterias}
+        if not criterias:
+            return ranking
+
+        query = cls.ranking_query(criterias)
+        cursor.execute(*query.select(query.criteria, query.application,
+                order_by=[query.criteria, query.rank]))
+        for criteria_id, application_id in cursor:
+            ranking[criteria_id].append(application_id)
+        return ranking
+
+    @classmethod
+    def allocate(cls, criterias, applications=None):
+        """Return the (id, score) of the applications admitted by each criteria
+        by rank
+
+        The eligible applications fill the quota of their modality then the
+        open seats in one pass over the ranking. With applications, only
+        those not evaluated yet are allocated to the seats left by the
+        admitted results. The seats of the quotas left unused spill over at
+        the end, so all the applications of an evaluation must be allocated
+        at once.
+        """
+        pool = Pool()
+        Result = pool.get('akademy_matriculation.applications.result')
+        Applications = pool.get('akademy_matriculation.applications')
+        result = Result.__table__()
+        evaluated = Result.__table__()
+        application = Applications.__table__()
+        cursor = Transaction().connection.cursor()
+        admitted = {c.id: [] for c in criterias}
+        if not criterias:
+            return admitted
+        quotas = {c.id: {r.reference.id: r.seats for r in c.references if r.seats}
+            for c in criterias}
+        limits = {c.id: c.student_limit for c in criterias}
+
+        taken = defaultdict(dict)
+        query = cls.ranking_query(criterias)
+        where = Literal(True)
+        if applications is not None:
+            where = (reduce_ids(query.application, list(map(int, applications)))
+                & ~Exists(evaluated.select(evaluated.id,
+                        where=(evaluated.application == query.application)
+                        & (evaluated.application_criteria == query.criteria))))
+            result_where = (reduce_ids(result.application_criteria, list(admitted))
+                & (result.result == 'Admitido'))
+            company = Transaction().context.get('company')
+            if company:
+                result_where &= result.company == company
+            cursor.execute(*result.join(application,
+                    condition=result.application == application.id
+                    ).select(
+                    result.application_criteria, result.company,
+                    application.reference, Count(Literal('*')),
+                    where=result_where,
+                    group_by=[result.application_criteria, result.company,
+                        application.reference]))
+            for criteria_id, company_id, reference_id, count in cursor:
+                taken[(criteria_id, company_id)][reference_id] = count
+
+        cursor.execute(*query.select(
+                query.criteria, query.company, query.application,
+                query.reference, query.score,
+                where=where,
+                order_by=[query.criteria, query.company, query.rank]))
+        for (criteria_id, company_id), rows in groupby(
+                cursor.fetchall(), key=lambda r: r[:2]):
+            rows = list(rows)
+            scores = {r[2]: r[4] for r in rows}
+            allocator = QuotaAllocator(limits[criteria_id],
+                quotas[criteria_id], taken.get((criteria_id, company_id)))
+            admitted[criteria_id].extend((a, scores[a])
+                for a in allocator.allocate([r[2:4] for r in rows]))
+        return admitted
+
+    @classmethod
+    def get_cut_off(cls, criterias, name):
+        return {criteria_id: min((s for _, s in admitted), default=None)
+            for criteria_id, admitted in cls.allocate(criterias).items()}
+
+    @classmethod
+    def get_admitted_applications(cls, criterias, name):
+        return {criteria_id: [a for a, _ in admitted]
+            for criteria_id, admitted in cls.allocate(criterias).items()}
+
+    @classmethod
+    def get_remaining_seats(cls, criterias, name):
+        pool = Pool()
+        Result = pool.get('akademy_matriculation.applications.result')
+        result = Result.__table__()
+        cursor = Transaction().connection.cursor()
+        remaining = {c.id: c.student_limit for c in criterias}
+
+        where = (result.application_criteria.in_(list(remaining))
+            & (result.result == 'Admitido'))
+        company = Transaction().context.get('company')
+        if company:
+            where &= result.company == company
+        cursor.execute(*result.select(
+                result.application_criteria, Count(result.id),
+                where=where, group_by=[result.application_criteria]))
+        for criteria_id, admitted in cursor:
+            remaining[criteria_id] -= admitted
+        return remaining
+
+    @classmethod
+    def get_eligibility_index(cls):
+        "Return the criteria of the open phases sorted by average"
+        today = date.today()
+        index = cls._eligibility_cache.get(today.isoformat())
+        if index is not None:
+            return index
+
+        Phase = Pool().get('akademy_configuration.phase')
+        criteria = cls.__table__()
+        phase = Phase.__table__()
+        cursor = Transaction().connection.cursor()
+        cursor.execute(*criteria.join(phase,
+                condition=criteria.phase == phase.id
+                ).select(
+                criteria.average, criteria.age, criteria.academic_level,
+                criteria.id,
+                where=(phase.start <= today) & (phase.end >= today),
+                order_by=[criteria.average.asc, criteria.id.asc]))
+        rows = cursor.fetchall()
+        index = {
+            'averages': [r[0] for r in rows],
+            'criterias': [list(r[1:]) for r in rows],
+            }
+        cls._eligibility_cache.set(today.isoformat(), index)
+        return index
+
+    @classmethod
+    def search_eligible(cls, average, age=None, academic_level=None):
+        "Return the ids of the open criteria the average and age qualify for"
+        index = cls.get_eligibility_index()
+        position = bisect_right(index['averages'], Decimal(str(average)))
+        return [criteria_id
+            for criteria_age, criteria_level, criteria_id
+            in index['criterias'][:position]
+            if (age is None or criteria_age is None or age <= criteria_age)
+            and (academic_level is None or academic_level == criteria_level)]
+
+
+class LectiveYearCloneStart(ModelView):
+    'Lective Year Clone Start'
+    __name__ = 'akademy_matriculation.lective_year.clone.start'
+
+    source = fields.Many2One('akademy_configuration.lective.year',
+        'Ano letivo de origem', required=True,
+        help="Ano letivo cujas fases e critérios serão copiados.")
+    target = fields.Many2One('akademy_configuration.lective.year',
+        'Ano letivo de destino', required=True,
+        domain=[('id', '!=', Eval('source', -1))], depends=['source'],
+        help="Ano letivo onde as fases e critérios serão criados.")
+    months = fields.Integer('Deslocamento (meses)', required=True,
+        help="Número de meses a acrescentar às datas das fases.")
+    seat_adjustment = fields.Numeric('Ajuste de vagas (%)', digits=(3,1),
+        domain=[('seat_adjustment', '>', -100)],
+        help="Percentagem a aplicar ao total de vagas de cada critério.")
+
+    @classmethod
+    def default_source(cls):
+        context = Transaction().context
+        if context.get('active_model') == 'akademy_configuration.lective.year':
+            return context.get('active_id')
+
+    @classmethod
+    def default_months(cls):
+        return 12
+
+    @classmethod
+    def default_seat_adjustment(cls):
+        return Decimal(0)
+
+
+class LectiveYearClone(Wizard):
+    'Lective Year Clone'
+    __name__ = 'akademy_matriculation.lective_year.clone'
+
+    start_state = 'start'
+    start = StateView(
+        'akademy_matriculation.lective_year.clone.start',
+        'akademy_matriculation.lective_year_clone_start_view_form', [
+            Button(string=u'Cancelar', state='end', icon='tryton-cancel'),
+            Button(string=u'Copiar', state='clone', icon='tryton-ok', default=True)
+        ]
+    )
+    clone = StateTransition()
+
+    @staticmethod
+    def rename(value, source, target):
+        if value and source.name in value:
+            return value.replace(source.name, target.name)
+        return value
+
+    @metrics.timed('akademy_wizard_seconds')
+    def transition_clone(self):
+        pool = Pool()
+        Phase = pool.get('akademy_configuration.phase')
+        ApplicationCriteria = pool.get('akademy_configuration.application.criteria')
+        source, target = self.start.source, self.start.target
+        shift = relativedelta(months=self.start.months)
+        factor = 1 + (self.start.seat_adjustment or 0) / 100
+        if factor <= 0:
+            raise UserError("Não foi possível copiar o ano letivo "+source.name+
+                ", porque o ajuste de vagas deve ser superior a -100%.")
+
+        phases = Phase.search([('lective_year', '=', source)],
+            order=[('start', 'ASC'), ('id', 'ASC')])
+        criterias = ApplicationCriteria.search([('lective_year', '=', source)])
+        if not phases:
+            raise UserError("Não foi possível copiar o ano letivo "+source.name+
+                ", porque não tem fases de admissão.")
+
+        phase_vlist = []
+        for phase in phases:
+            name = self.rename(phase.name, source, target)
+            if name == phase.name:
+                name = phase.name+" - "+target.name
+            code = self.rename(phase.code, source, target)
+            phase_vlist.append({
+                'name': name,
+                'code': code if code != phase.code else None,
+                'start': phase.start + shift,
+                'end': phase.end + shift,
+                'lective_year': target.id,
+                'seat_hold_days': phase.seat_hold_days,
+            })
+
+        # Check the unique keys before creating anything, like SQL a phase
+        # without code never collides
+        phase_keys = {(v['name'], v['code']) for v in phase_vlist
+            if v['code'] is not None}
+        for phase in Phase.search([
+                    ('name', 'in', [n for n, _ in phase_keys]),
+                    ('code', '!=', None),
+                    ]):
+            if (phase.name, phase.code) in phase_keys:
+                raise UserError("Não foi possível copiar o ano letivo "+source.name+
+                    ", porque a fase de admissão "+phase.name+" já existe.")
+
+        phase_names = {p.id: v['name'] for p, v in zip(phases, phase_vlist)}
+        # The criteria of the target are compared by the name of their phase
+        criteria_keys = {(c.name, c.course.id, c.phase.name)
+            for c in ApplicationCriteria.search([('lective_year', '=', target)])}
+        # The reserved seats follow the adjustment of the total of seats
+        seats = {c.id: scale_seats(c.student_limit,
+                [r.seats for r in c.references], factor)
+            for c in criterias}
+        for criteria in criterias:
+            if criteria.phase.id not in phase_names:
+                raise UserError("Não foi possível copiar o critério de admissão "+criteria.name+
+                    ", porque a sua fase não pertence ao ano letivo "+source.name+".")
+            key = (criteria.name, criteria.course.id, phase_names[criteria.phase.id])
+            if key in criteria_keys:
+                raise UserError("Não foi possível copiar o ano letivo "+source.name+
+                    ", porque o critério de admissão "+criteria.name+" já existe no ano letivo "+target.name+".")
+            criteria_keys.add(key)
+
+        new_phases = Phase.create(phase_vlist)
+        phase_map = {p.id: n.id for p, n in zip(phases, new_phases)}
+
+        ApplicationCriteria.create([{
+                'code': criteria.code,
+                'name': criteria.name,
+                'description': criteria.description,
+                'age': criteria.age,
+                'average': criteria.average,
+                'student_limit': seats[criteria.id][0],
+                'lective_year': target.id,
+                'academic_level': criteria.academic_level.id,
+                'area': criteria.area.id,
+                'course': criteria.course.id,
+                'course_classe': criteria.course_classe.id,
+                'phase': phase_map[criteria.phase.id],
+                'age_threshold': criteria.age_threshold,
+                'age_penalty': criteria.age_penalty,
+                'references': [('create', [{
+                                'reference': r.reference.id,
+                                'bonus': r.bonus,
+                                'seats': s,
+                                } for r, s in zip(criteria.references,
+                                seats[criteria.id][1])])],
+            } for criteria in criterias])
+        return 'end'
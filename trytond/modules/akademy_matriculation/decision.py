@@ -0,0 +1,76 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from trytond.model import Index, ModelSQL, ModelView, fields
+
+sel_failed_check = [
+    (None, ''),
+    ('average', 'Média'),
+    ('age', 'Idade'),
+    ('phase', 'Fase'),
+]
+
+
+class AdmissionDecision(ModelSQL, ModelView):
+    'Admission Decision'
+    __name__ = 'akademy_matriculation.admission.decision'
+
+    application = fields.Many2One('akademy_matriculation.applications',
+        'Candidatura', required=True, readonly=True, ondelete="CASCADE")
+    application_criteria = fields.Many2One(
+        'akademy_configuration.application.criteria', 'Critério de admissão',
+        required=True, readonly=True, ondelete="CASCADE")
+    result = fields.Char('Resultado', readonly=True)
+    failed_check = fields.Selection(sel_failed_check, 'Critério falhado',
+        readonly=True, help="Primeira condição do critério não cumprida.")
+    criteria_average = fields.Numeric('Média mínima', digits=(2,1),
+        readonly=True)
+    criteria_age = fields.Integer('Idade máxima', readonly=True)
+    candidate_average = fields.Numeric('Média do candidato', digits=(2,1),
+        readonly=True)
+    candidate_age = fields.Integer('Idade do candidato', readonly=True)
+    rank = fields.Integer('Posição', readonly=True)
+    seats_remaining = fields.Integer('Vagas disponíveis', readonly=True,
+        help="Vagas disponíveis no momento da avaliação.")
+
+    @classmethod
+    def __setup__(cls):
+        super(AdmissionDecision, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table, (table.application, Index.Equality())),
+        })
+        cls._order = [('create_date', 'DESC')]
+
+    @classmethod
+    def get_values(cls, application, criteria, result, rank, seats_remaining):
+        "Return the values of the decision taken on the application"
+        candidate_average = application.candidate.average
+        candidate_age = application.age
+        if criteria.average > candidate_average:
+            failed_check = 'average'
+        elif candidate_age is not None and criteria.age < candidate_age:
+            failed_check = 'age'
+        elif criteria.phase.id < application.phase.id:
+            failed_check = 'phase'
+        else:
+            failed_check = None
+        return {
+            'application': application.id,
+            'application_criteria': criteria.id,
+            'result': result,
+            'failed_check': failed_check,
+            'criteria_average': criteria.average,
+            'criteria_age': criteria.age,
+            'candidate_average': candidate_average,
+            'candidate_age': candidate_age,
+            'rank': rank,
+            'seats_remaining': seats_remaining,
+            }
+
+    @classmethod
+    def flush(cls, decisions):
+        "Create the buffered decisions at once and empty the buffer"
+        if decisions:
+            cls.create(decisions)
+            del decisions[:]
@@ -0,0 +1,18 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.extend([
+            ('akademy_matriculation.seat.reservation|release_expired',
+                "Libertar reservas de vagas expiradas"),
+            ('akademy_matriculation.notification|drain',
+                "Enviar notificações pendentes"),
+        ])
@@ -1,19 +1,41 @@
 # This file is part of SAGE Education.   The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
-from trytond.model import Check, ModelSQL, ModelView, Unique, fields, sort
-from trytond.wizard import Button, StateTransition, StateView, Wizard
-from trytond.pyson import Bool, Eval, Not
+from sql import Literal, Null
+from sql.aggregate import Count
+from sql.functions import CurrentTimestamp
+from sql.operators import Exists
+
+from trytond.model import (
+    Check, DeactivableMixin, Index, ModelSQL, ModelView, Unique, fields)
+from trytond.wizard import (
+    Button, StateAction, StateTransition, StateView, Wizard)
+from trytond.pyson import Bool, Eval, Not, PYSONEncoder
 from trytond.exceptions import UserError
 from trytond.pool import Pool
+from trytond.rpc import RPC
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
 from datetime import datetime, date
+from decimal import Decimal, InvalidOperation
 from dateutil.relativedelta import relativedelta
+from difflib import SequenceMatcher
+from functools import partial
 
 from ..akademy_classe.classe import ClasseStudentDiscipline
 from ..akademy_classe.variables import sel_result
+from . import metrics
+from .allocation import ClasseAllocator
+from .replica import ReplicaReadMixin
+from .waitlist import vacancies, withdrawal_refusal
+from .tools import (
+    blocking_key, iter_ids, iter_pages, normalize_name, prefetch_fields)
 
+state_student_not_associated = [
+    'Aguardando', 'Suspenso(a)', 'Anulada', 'Transfêrido(a)', 'Reprovado(a)']
 
-class Candidates(ModelSQL, ModelView):
+
+class Candidates(ReplicaReadMixin, DeactivableMixin, ModelSQL, ModelView):
     'Candidates'
     __name__ = 'akademy_matriculation.candidates'      
 
@@ -41,6 +63,11 @@ class Candidates(ModelSQL, ModelView):
         'Nível acadêmico', required=True, ondelete="RESTRICT") 
     applications = fields.One2Many('akademy_matriculation.applications', 
         'candidate', 'Candidaturas')
+    eligible_criteria = fields.Function(
+        fields.One2Many('akademy_configuration.application.criteria', None,
+            'Critérios elegíveis',
+            help="Critérios de admissão da fase em curso a que o candidato pode concorrer."),
+        'get_eligible_criteria')
 
     @classmethod
     def __setup__(cls):
@@ -57,6 +84,9 @@ class Candidates(ModelSQL, ModelView):
             u'Não foi possível cadastrar o novo candidato, por favor verificar se a média do certificado é maior que 20.')
         ]
         cls._order = [('party', 'ASC')]
+        cls.__rpc__.update({
+            'eligibility': RPC(instantiate=None),
+        })
 
     '''
     @classmethod
@@ -69,20 +99,106 @@ class Candidates(ModelSQL, ModelView):
                     raise UserError("Não foi possível eliminar a candidatura, por favor verificar se a mesma encontra-se bloqueada.")
     '''
             
+    @classmethod
+    def write(cls, *args):
+        Applications = Pool().get('akademy_matriculation.applications')
+        super(Candidates, cls).write(*args)
+        actions = iter(args)
+        to_score = []
+        for candidates, values in zip(actions, actions):
+            if values.keys() & {'average', 'party'}:
+                to_score.extend(candidates)
+        if to_score:
+            Applications.compute_scores(Applications.search([
+                        ('candidate', 'in', [c.id for c in to_score]),
+                        ]))
+
+    @classmethod
+    def validate(cls, candidates):
+        super(Candidates, cls).validate(candidates)
+        AcademicLevel = Pool().get('akademy_configuration.academic.level')
+        AcademicLevel.check_catalogue(candidates)
+
     def get_rec_name(self, name):
         return self.party.rec_name
 
     @classmethod
     def search_rec_name(cls, name, clause):
         return [('party.rec_name',) + tuple(clause[1:])]
+
+    def get_eligible_criteria(self, name):
+        ApplicationCriteria = Pool().get('akademy_configuration.application.criteria')
+        if self.average is None:
+            return []
+        age = None
+        if self.party and self.party.date_birth:
+            age = relativedelta(date.today(), self.party.date_birth).years
+        return ApplicationCriteria.search_eligible(self.average, age,
+            self.academic_level.id if self.academic_level else None)
+
+    @classmethod
+    def eligibility(cls, average, age=None, academic_level=None):
+        "Return the open criteria the average and age qualify for with their seats"
+        ApplicationCriteria = Pool().get('akademy_configuration.application.criteria')
+        criterias = ApplicationCriteria.browse(
+            ApplicationCriteria.search_eligible(average, age, academic_level))
+        remaining_seats = ApplicationCriteria.get_remaining_seats(
+            criterias, 'remaining_seats')
+        return [{
+                'id': criteria.id,
+                'name': criteria.rec_name,
+                'course': criteria.course.rec_name,
+                'course_classe': criteria.course_classe.rec_name,
+                'phase': criteria.phase.rec_name,
+                'average': criteria.average,
+                'age': criteria.age,
+                'remaining_seats': remaining_seats[criteria.id],
+            } for criteria in criterias]
+
+    @classmethod
+    def find_duplicates(cls, threshold=0.85):
+        "Return the groups of ids of candidates likely to be the same person"
+        Party = Pool().get('party.party')
+        candidate = cls.__table__()
+        party = Party.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Only the candidates of the same block are compared
+        blocks = {}
+        cursor.execute(*candidate.join(party,
+                condition=candidate.party == party.id
+                ).select(candidate.id, party.id, party.name, party.date_birth,
+                where=candidate.active == True))
+        for candidate_id, party_id, name, date_birth in cursor:
+            key = blocking_key(name, date_birth)
+            if key:
+                blocks.setdefault(key, []).append(
+                    (candidate_id, party_id, normalize_name(name)))
+
+        duplicates = []
+        for block in blocks.values():
+            if len({party_id for _, party_id, _ in block}) < 2:
+                continue
+            group = set()
+            for i, (id1, party1, name1) in enumerate(block):
+                for id2, party2, name2 in block[i + 1:]:
+                    if (party1 != party2
+                            and SequenceMatcher(None, name1, name2).ratio()
+                            >= threshold):
+                        group.update([id1, id2])
+            if group:
+                duplicates.append(sorted(group))
+        return duplicates
   
 
-class Applications(ModelSQL, ModelView):
+class Applications(ReplicaReadMixin, DeactivableMixin, ModelSQL, ModelView):
     'Applications'
     __name__ = 'akademy_matriculation.applications' 
             
     state = fields.Boolean('Avaliado')
     description = fields.Text('Descrição')
+    company = fields.Many2One('company.company', 'Escola', required=True,
+        ondelete="RESTRICT", help="Escola a que pertence o registo.")
     reference = fields.Many2One('akademy_configuration.matriculation.reference', 
         'Modalidade', required=True, help="Escolha a modalidade de candidatura.")
     age = fields.Function(
@@ -111,6 +227,23 @@ class Applications(ModelSQL, ModelView):
     result = fields.One2Many('akademy_matriculation.applications.result', 
         'application', 'Resultado', 
         states={'invisible': Not(Bool(Eval('state')))}, depends=['state'])
+    decisions = fields.One2Many('akademy_matriculation.admission.decision',
+        'application', 'Decisões', readonly=True,
+        help="Registo das avaliações da candidatura.")
+    score = fields.Numeric('Pontuação', digits=(4,2), readonly=True,
+        help="Média com as bonificações e penalizações do critério de admissão.")
+    rank = fields.Function(
+        fields.Integer('Posição',
+            help="Posição do candidato no critério de admissão."),
+        'get_rank', searcher='search_rank')
+    admission_criteria = fields.Function(
+        fields.Many2One('akademy_configuration.application.criteria',
+            'Critério de admissão'),
+        'get_rank')
+    within_limit = fields.Function(
+        fields.Boolean('Dentro das vagas',
+            help="A posição do candidato está dentro do limite de vagas."),
+        'get_rank', searcher='search_within_limit')
 
     @classmethod
     def __setup__(cls):
@@ -121,6 +254,91 @@ class Applications(ModelSQL, ModelView):
             u'Não foi possível inscrever o candidato, porque o candidato já esta inscrito neste curso, fase e ano letivo.')
         ]       
         cls._order = [('candidate.party', 'ASC')]     
+        cls._sql_indexes.update({
+            Index(table,
+                (table.company, Index.Equality()),
+                (table.lective_year, Index.Equality()),
+                (table.phase, Index.Equality()),
+                (table.course, Index.Equality()),
+                where=table.active == True),
+            Index(table,
+                (table.company, Index.Equality()),
+                (table.lective_year, Index.Equality()),
+                (table.phase, Index.Equality()),
+                (table.course, Index.Equality()),
+                where=(table.active == True)
+                & ((table.state == False) | (table.state == Null))),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        Candidates = Pool().get('akademy_matriculation.candidates')
+        table = cls.__table__()
+        candidate = Candidates.__table__()
+        cursor = Transaction().connection.cursor()
+
+        super(Applications, cls).__register__(module_name)
+
+        # Migration from 1.0.3: the applications belong to the school of
+        # their candidate
+        cursor.execute(*table.update([table.company],
+                [candidate.select(candidate.institution,
+                        where=candidate.id == table.candidate)],
+                where=table.company == Null))
+        cls.__table_handler__(module_name).not_null_action('company', 'add')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def create(cls, vlist):
+        Candidates = Pool().get('akademy_matriculation.candidates')
+        vlist = [x.copy() for x in vlist]
+        # The school of the candidate comes before the one of the user
+        for values in vlist:
+            if not values.get('company') and values.get('candidate'):
+                values['company'] = Candidates(values['candidate']).institution.id
+        applications = super(Applications, cls).create(vlist)
+        cls.compute_scores(applications)
+        return applications
+
+    @classmethod
+    def write(cls, *args):
+        super(Applications, cls).write(*args)
+        actions = iter(args)
+        to_score = []
+        for applications, values in zip(actions, actions):
+            if values.keys() & {'candidate', 'reference', 'lective_year',
+                    'academic_level', 'area', 'course', 'course_classe',
+                    'phase'}:
+                to_score.extend(applications)
+        if to_score:
+            cls.compute_scores(to_score)
+
+    @classmethod
+    def compute_scores(cls, applications):
+        "Score the applications with the formula of their admission criteria"
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        applications = cls.browse(list(map(int, applications)))
+        if not applications:
+            return
+        # Without a matching criteria the average is ranked
+        for sub_ids in grouped_slice([a.id for a in applications]):
+            cursor.execute(*table.update([table.score], [Null],
+                    where=reduce_ids(table.id, list(sub_ids))))
+        criterias = Criteria.search([
+            ('course', 'in', list({a.course.id for a in applications})),
+            ('phase', 'in', list({a.phase.id for a in applications})),
+            ])
+        Criteria.compute_scores(criterias, applications)
+
+    @fields.depends('candidate', 'company')
+    def on_change_candidate(self):
+        if self.candidate and self.candidate.institution:
+            self.company = self.candidate.institution
 
     '''
     @classmethod
@@ -132,6 +350,12 @@ class Applications(ModelSQL, ModelView):
                 raise UserError("Não foi possível eliminar q candidatura, por favor verificar se a mesma encontra-se bloqueada.")
     '''
     
+    @classmethod
+    def validate(cls, applications):
+        super(Applications, cls).validate(applications)
+        AcademicLevel = Pool().get('akademy_configuration.academic.level')
+        AcademicLevel.check_catalogue(applications)
+
     def get_rec_name(self, name):
         return self.candidate.rec_name
 
@@ -150,9 +374,165 @@ class Applications(ModelSQL, ModelView):
                 return years_months_days
         
         return None
+
+    @classmethod
+    def get_rank(cls, applications, names):
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        cursor = Transaction().connection.cursor()
+        result = {n: dict.fromkeys([a.id for a in applications])
+            for n in names}
+
+        criterias = Criteria.search([
+            ('course', 'in', list({a.course.id for a in applications})),
+            ('phase', 'in', list({a.phase.id for a in applications})),
+            ])
+        if not criterias:
+            return result
+
+        admitted = set()
+        if 'within_limit' in result:
+            admitted = {(c, a) for c, rows in Criteria.allocate(criterias).items()
+                for a, _ in rows}
+        query = Criteria.ranking_query(criterias)
+        cursor.execute(*query.select(
+                query.application, query.criteria, query.rank,
+                where=query.application.in_([a.id for a in applications]),
+                order_by=[query.rank.desc]))
+        # Keep the best position when several criteria match
+        for application_id, criteria_id, rank in cursor:
+            if 'rank' in result:
+                result['rank'][application_id] = rank
+            if 'admission_criteria' in result:
+                result['admission_criteria'][application_id] = criteria_id
+            if 'within_limit' in result:
+                result['within_limit'][application_id] = (
+                    (criteria_id, application_id) in admitted)
+        return result
+
+    @classmethod
+    def _ranking_search(cls, where, operator='in'):
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        # Only the applications of the years not archived are ranked
+        criterias = Criteria.search([
+                ('lective_year.matriculation_archived', '=', False),
+                ])
+        if not criterias:
+            return [('id', '=' if operator == 'in' else '!=', None)]
+
+        query = Criteria.ranking_query(criterias)
+        return [('id', operator, query.select(query.application,
+                    where=where(query)))]
+
+    @classmethod
+    def search_rank(cls, name, clause):
+        _, operator, value = clause
+        Operator = fields.SQL_OPERATORS[operator]
+        return cls._ranking_search(lambda query: Operator(query.rank, value))
+
+    @classmethod
+    def search_within_limit(cls, name, clause):
+        _, operator, value = clause
+        if (operator, value) in {('=', True), ('!=', False)}:
+            operator = 'in'
+        else:
+            operator = 'not in'
+        # The quotas of the modalities can not be expressed by the rank, only
+        # the criteria of the years not archived are allocated so the
+        # applications of the archived years match neither value
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        admitted = Criteria.allocate(Criteria.search([
+                    ('lective_year.matriculation_archived', '=', False),
+                    ]))
+        return [
+            ('id', operator,
+                [a for rows in admitted.values() for a, _ in rows]),
+            ('lective_year.matriculation_archived', '=', False),
+            ]
             
     @classmethod
-    def application_admission_avaliation(cls, ApplicationCriteria, application, ApplicationResult, lective_year):           
+    def check_evaluation(cls, application_ids):
+        "Return the error message of each application which can not be evaluated"
+        pool = Pool()
+        Criteria = pool.get('akademy_configuration.application.criteria')
+        Result = pool.get('akademy_matriculation.applications.result')
+        application = cls.__table__()
+        criteria = Criteria.__table__()
+        result = Result.__table__()
+        cursor = Transaction().connection.cursor()
+
+        errors = {}
+        for sub_ids in grouped_slice(application_ids):
+            sub_ids = list(sub_ids)
+            cursor.execute(*application.join(criteria, 'LEFT',
+                    condition=(criteria.course == application.course)
+                    & (criteria.phase == application.phase)
+                    ).select(application.id,
+                    where=reduce_ids(application.id, sub_ids)
+                    & (criteria.id == Null)))
+            for application_id, in cursor:
+                errors[application_id] = ("Não foi possível avaliar a candidatura, porque não foi possível encontrar "+
+                    "um critério de admissão para o curso e a fase da candidatura.")
+
+            cursor.execute(*result.select(result.application,
+                    where=reduce_ids(result.application, sub_ids),
+                    group_by=[result.application],
+                    having=Count(result.id) > 1))
+            for application_id, in cursor:
+                errors.setdefault(application_id, "Não foi possível avaliar a candidatura, "+
+                    "por favor verificar se já existe uma candidatura avaliada para o mesmo.")
+        return errors
+
+    @classmethod
+    def rollover(cls, phase, next_phase):
+        """Copy the applications of phase not admitted to next_phase
+
+        The unevaluated and not admitted applications are inserted with one
+        query, skipping those already registered in the next phase.
+        It returns the number of applications copied.
+        """
+        Result = Pool().get('akademy_matriculation.applications.result')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        application = cls.__table__()
+        existing = cls.__table__()
+        result = Result.__table__()
+
+        admitted = result.select(Literal(1),
+            where=(result.application == application.id)
+            & (result.result == 'Admitido'))
+        registered = existing.select(Literal(1),
+            where=(existing.candidate == application.candidate)
+            & (existing.course == application.course)
+            & (existing.phase == next_phase.id)
+            & (existing.lective_year == application.lective_year))
+        query = application.select(
+            transaction.user, CurrentTimestamp(), Literal(True),
+            Literal(False), application.company, application.description,
+            application.reference,
+            application.candidate, Literal(next_phase.id),
+            application.lective_year, application.academic_level,
+            application.area, application.course, application.course_classe,
+            where=(application.phase == phase.id)
+            & (application.active == True)
+            & ~Exists(admitted)
+            & ~Exists(registered))
+        cursor.execute(*application.insert(
+                columns=[
+                    application.create_uid, application.create_date,
+                    application.active, application.state,
+                    application.company, application.description,
+                    application.reference,
+                    application.candidate, application.phase,
+                    application.lective_year, application.academic_level,
+                    application.area, application.course,
+                    application.course_classe],
+                values=query))
+        return cursor.rowcount
+
+    @classmethod
+    def application_admission_avaliation(cls, ApplicationCriteria, application, ApplicationResult, lective_year, decisions=None, rank=None, notifications=None, allocation=None):           
+        Decision = Pool().get('akademy_matriculation.admission.decision')
+        Notification = Pool().get('akademy_matriculation.notification')
         
         if (len(ApplicationCriteria) >= 1):
             for application_criteria in ApplicationCriteria:
@@ -165,43 +545,72 @@ class Applications(ModelSQL, ModelView):
                     if ((application_criteria.average <= application.candidate.average)
                     and (application_criteria.age >= application.age)
                     and (application_criteria.phase >= application.phase)):
-                        result_avaliation = 'Admitido'
-                        Applications.application_admission(ApplicationResult, application, application_criteria, result_avaliation, lective_year) 
+                        admitted = allocation.get(application_criteria.id) if allocation is not None else None
+                        seats = Applications.application_admission(ApplicationResult, application, application_criteria, 'Admitido', lective_year, admitted) 
+                        # Without a seat left the candidate goes to the waitlist
+                        result_avaliation = 'Admitido' if seats > 0 else 'Não admitido'
                     else:                   
                         result_avaliation = 'Não admitido'
-                        Applications.application_admission(ApplicationResult, application, application_criteria, result_avaliation, lective_year)
+                        seats = Applications.application_admission(ApplicationResult, application, application_criteria, result_avaliation, lective_year)
+
+                    if decisions is not None:
+                        decisions.append(Decision.get_values(
+                            application, application_criteria, result_avaliation, rank, seats))
+                    if notifications is not None:
+                        notifications.append(Notification.get_values(
+                            'admission', application, result=result_avaliation))
         else:
             raise UserError("Não foi possível avaliar a candidatura, por favor,"+
                             " verifica se existe pelo menos um critério de admissão para o curso de "+
                             application.course.name+".")
     
     @classmethod
-    def application_admission(cls, ApplicationResult, application, criteria, result_avaliation, lective_year):                 
-        total_application_admission = ApplicationResult.search([
+    def application_admission(cls, ApplicationResult, application, criteria, result_avaliation, lective_year, admitted=None):                 
+        total_application_admission = ApplicationResult.search_count([
+            ('company', '=', application.company),
             ('application_criteria', '=', criteria), ('result', '=', 'Admitido')
             ]) 
+        waitlisted = False
+        # admitted are the applications given a seat of their quota
+        if (result_avaliation == 'Admitido'
+                and (criteria.student_limit <= total_application_admission
+                    or (admitted is not None and application.id not in admitted))):
+            result_avaliation = 'Não admitido'
+            waitlisted = True
         
-        if criteria.student_limit > len(total_application_admission):  
-            candidate_has_evaluation = ApplicationResult.search([
-                ('phase', '=', criteria.phase), ('application', '=', application),
-                ('application_criteria', '=', criteria), ('lective_year', '=', lective_year)
-                ])   
-            
-            if len(candidate_has_evaluation) > 0:
-                pass
-            else:
-                Result = ApplicationResult(
-                    result = result_avaliation,
-                    phase = criteria.phase,
-                    application = application,
-                    application_criteria = criteria,
-                    lective_year = lective_year
-                )
-                Result.save() 
-                
-                Applications.application_change_state(application)
+        candidate_has_evaluation = ApplicationResult.search([
+            ('phase', '=', criteria.phase), ('application', '=', application),
+            ('application_criteria', '=', criteria), ('lective_year', '=', lective_year)
+            ])   
+        
+        if len(candidate_has_evaluation) > 0:
+            pass
         else:
-            raise UserError("Já atingiu o limite máximo de vagas disponíveis.") 
+            Result = ApplicationResult(
+                result = result_avaliation,
+                phase = criteria.phase,
+                application = application,
+                application_criteria = criteria,
+                lective_year = lective_year,
+                company = application.company
+            )
+            Result.save() 
+            if waitlisted:
+                Waitlist = Pool().get('akademy_matriculation.waitlist')
+                Waitlist.append([Result])
+            SeatReservation = Pool().get('akademy_matriculation.seat.reservation')
+            SeatReservation.hold([Result])
+            if result_avaliation == 'Admitido':
+                metrics.inc('akademy_admissions_total', model=cls.__name__)
+                metrics.set_gauge('akademy_seats_remaining',
+                    criteria.student_limit - total_application_admission - 1,
+                    criteria=criteria.rec_name)
+            
+            Applications.application_change_state(application)
+
+        if waitlisted:
+            return 0
+        return criteria.student_limit - total_application_admission
 
     @classmethod
     def application_change_state(cls, application):        
@@ -209,7 +618,7 @@ class Applications(ModelSQL, ModelView):
         application.save()   
                                         	
     
-class ApplicationsResult(ModelSQL, ModelView):
+class ApplicationsResult(ReplicaReadMixin, DeactivableMixin, ModelSQL, ModelView):
     'Applications Result'
     __name__ = 'akademy_matriculation.applications.result'
         
@@ -221,16 +630,95 @@ class ApplicationsResult(ModelSQL, ModelView):
         'Critério de admissão', required=True, ondelete="RESTRICT")
     lective_year = fields.Many2One('akademy_configuration.lective.year', 
         'Ano letivo', required=True, ondelete="RESTRICT")
+    company = fields.Many2One('company.company', 'Escola', required=True,
+        ondelete="RESTRICT", help="Escola a que pertence o registo.")
+    withdrawn = fields.Boolean('Desistiu', readonly=True,
+        help="O candidato admitido desistiu da vaga.")
      
     @classmethod
     def __setup__(cls):
         super(ApplicationsResult, cls).__setup__()
+        cls._buttons.update({
+            'withdraw': {
+                'invisible': Eval('result') != 'Admitido',
+                'depends': ['result'],
+            },
+        })
         table = cls.__table__()
         cls._sql_constraints = [
             ('key', Unique(table, table.application, table.application_criteria),
             u'A candidatura já foi avaliada.')
         ]     
         cls._order = [('application.candidate.party', 'ASC')] 
+        cls._sql_indexes.update({
+            Index(table,
+                (table.company, Index.Equality()),
+                (table.application_criteria, Index.Equality()),
+                (table.result, Index.Equality()),
+                where=table.active == True),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        pool = Pool()
+        Applications = pool.get('akademy_matriculation.applications')
+        Candidates = pool.get('akademy_matriculation.candidates')
+        table = cls.__table__()
+        application = Applications.__table__()
+        candidate = Candidates.__table__()
+        cursor = Transaction().connection.cursor()
+
+        super(ApplicationsResult, cls).__register__(module_name)
+
+        # Migration from 1.0.3: the results belong to the school of the
+        # candidate of their application
+        cursor.execute(*table.update([table.company],
+                [application.join(candidate,
+                        condition=application.candidate == candidate.id
+                        ).select(candidate.institution,
+                        where=application.id == table.application)],
+                where=table.company == Null))
+        cls.__table_handler__(module_name).not_null_action('company', 'add')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_withdrawn(cls):
+        return False
+
+    @classmethod
+    @ModelView.button
+    def withdraw(cls, results):
+        "Release the seats of the admitted results and promote the waitlists"
+        pool = Pool()
+        SeatReservation = pool.get('akademy_matriculation.seat.reservation')
+        Waitlist = pool.get('akademy_matriculation.waitlist')
+
+        reservations = SeatReservation.search([
+            ('application_result', 'in', [r.id for r in results]),
+            ])
+        for result in results:
+            refusal = withdrawal_refusal(result.result, [r.state
+                    for r in reservations if r.application_result == result])
+            if refusal == 'not_admitted':
+                raise UserError("Não foi possível registar a desistência de "+result.rec_name+
+                    ", porque o candidato não está admitido.")
+            elif refusal == 'matriculated':
+                raise UserError("Não foi possível registar a desistência de "+result.rec_name+
+                    ", porque o candidato já está matriculado.")
+        held = [r for r in reservations if r.state == 'held']
+        if held:
+            SeatReservation.write(held, {'state': 'released'})
+        cls.write(results, {'result': 'Não admitido', 'withdrawn': True})
+        entries = Waitlist.search([('application_result', 'in', [r.id for r in results])])
+        if entries:
+            Waitlist.write(entries, {'state': 'withdrawn'})
+
+        for (criteria, company), quantity in vacancies(
+                (r.application_criteria, r.company) for r in results).items():
+            Waitlist.promote(criteria, company, quantity)
 
     '''
     @classmethod
@@ -247,7 +735,7 @@ class ApplicationsResult(ModelSQL, ModelView):
         return [('application.rec_name',) + tuple(clause[1:])]             
 
 
-class StudentTransfer(ModelSQL, ModelView):
+class StudentTransfer(ReplicaReadMixin, DeactivableMixin, ModelSQL, ModelView):
     'Student - Transfer'
     __name__ = 'akademy_matriculation.student.transfer'
 
@@ -306,6 +794,8 @@ class StudentTransfer(ModelSQL, ModelView):
 		depends=['course', 'internal'], help="Nome da classe.")
     student = fields.Many2One('company.student', 
         'Discente', required=True, ondelete="RESTRICT")
+    company = fields.Many2One('company.company', 'Escola', required=True,
+        ondelete="RESTRICT", help="Escola a que pertence o registo.")
     student_transfer_discipline = fields.One2Many(
 		'akademy_matriculation.student.transfer.discipline', 
         'student_transfer', 'Disciplina')
@@ -319,6 +809,34 @@ class StudentTransfer(ModelSQL, ModelView):
             Unique(table, table.lective_year, table.academic_level, table.course, table.course_classe, table.student),
             u'Não foi possível cadastrar a transferência, por favor verifique se o discente já se encontra com uma transferência com estes dados.')
         ]
+        cls._sql_indexes.update({
+            Index(table,
+                (table.company, Index.Equality()),
+                (table.lective_year, Index.Equality()),
+                (table.student, Index.Equality()),
+                where=table.active == True),
+        })
+
+    @classmethod
+    def __register__(cls, module_name):
+        Student = Pool().get('company.student')
+        table = cls.__table__()
+        student = Student.__table__()
+        cursor = Transaction().connection.cursor()
+
+        super(StudentTransfer, cls).__register__(module_name)
+
+        # Migration from 1.0.3: the transfers belong to the school of their
+        # student
+        cursor.execute(*table.update([table.company],
+                [student.select(student.company,
+                        where=student.id == table.student)],
+                where=table.company == Null))
+        cls.__table_handler__(module_name).not_null_action('company', 'add')
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
 
     @classmethod
     def create(cls, vlist):
@@ -326,47 +844,56 @@ class StudentTransfer(ModelSQL, ModelView):
         for values in vlist:
             records = super(StudentTransfer, cls).create(vlist)
             if records:
+                metrics.inc('akademy_transfers_total', len(records),
+                    model=cls.__name__)
                 if values.get('internal'):                    
-                    Student = Pool().get('company.student')
+                    ClasseStudent = Pool().get('akademy_classe.classe.student')
                     StudentTransferDiscipline = Pool().get('akademy_matriculation.student.transfer.discipline')
-                    student = Student(values['student'])
-                    classe_students = student.classe_student
 
                     for record in records:
-                        for classe_student in classe_students:
-
-                            if len(classe_student.historic_grades) > 0:
-                                for historic_grade in classe_student.historic_grades:                                    
-                                    student_transfer_discipline = StudentTransferDiscipline(
-                                        average = historic_grade.average,
-                                        student_transfer = record.id,
-                                        discipline = historic_grade.studyplan_discipline.discipline,
-                                        course = historic_grade.classes.studyplan.course.id, #record.student.course.id,#
-                                        course_classe = historic_grade.classes.studyplan.classe
-                                    )
-                                    student_transfer_discipline.save()
-                            else:    
-                                for classe_student_discipline in classe_student.classe_student_discipline:                                                                         
-                                    student_transfer_discipline = StudentTransferDiscipline(
-                                        average = 0,
-                                        student_transfer = record.id,
-                                        discipline = classe_student_discipline.studyplan_discipline.discipline,
-                                        course = classe_student.classes.studyplan.course.id, #record.student.course.id,#
-                                        course_classe = classe_student.classes.studyplan.classe
-                                    )
-                                    student_transfer_discipline.save()
+                        for classe_students in iter_pages(ClasseStudent, [('student', '=', values['student'])],
+                                prefetch=['historic_grades.studyplan_discipline.discipline',
+                                    'historic_grades.classes.studyplan',
+                                    'classe_student_discipline.studyplan_discipline.discipline',
+                                    'classes.studyplan']):
+                            student_transfer_disciplines = []
+                            for classe_student in classe_students:
+
+                                if len(classe_student.historic_grades) > 0:
+                                    for historic_grade in classe_student.historic_grades:                                    
+                                        student_transfer_disciplines.append({
+                                            'average': historic_grade.average,
+                                            'student_transfer': record.id,
+                                            'discipline': historic_grade.studyplan_discipline.discipline.id,
+                                            'course_classe': historic_grade.classes.studyplan.classe.id,
+                                        })
+                                else:    
+                                    for classe_student_discipline in classe_student.classe_student_discipline:                                                                         
+                                        student_transfer_disciplines.append({
+                                            'average': 0,
+                                            'student_transfer': record.id,
+                                            'discipline': classe_student_discipline.studyplan_discipline.discipline.id,
+                                            'course_classe': classe_student.classes.studyplan.classe.id,
+                                        })
+                            StudentTransferDiscipline.create(student_transfer_disciplines)
 
                 return records
             else:
                 raise UserError("Não foi possível associar a(s) disciplina(s) ao discente.")
 
+    @classmethod
+    def validate(cls, student_transfers):
+        super(StudentTransfer, cls).validate(student_transfers)
+        AcademicLevel = Pool().get('akademy_configuration.academic.level')
+        AcademicLevel.check_catalogue(student_transfers)
+
     def get_rec_name(self, name):
         t1 = '%s' % \
             (self.student.rec_name)
         return t1   
     
 
-class StudentTransferDiscipline(ModelSQL, ModelView):
+class StudentTransferDiscipline(ReplicaReadMixin, ModelSQL, ModelView):
     'Student Tranfer Discipline'
     __name__ = 'akademy_matriculation.student.transfer.discipline'
 
@@ -392,6 +919,10 @@ class StudentTransferDiscipline(ModelSQL, ModelView):
             Unique(table, table.student_transfer, table.discipline, table.course_classe),
             u'Não foi possível associar está disciplina ao discente, por favor verifique se o mesmo já têm esta disciplina associada.')            
         ]
+        cls.__rpc__.update({
+            'set_grades': RPC(readonly=False, instantiate=None,
+                result=lambda r: list(map(int, r))),
+        })
 
     def get_rec_name(self, name):
         t1 = '%s' % \
@@ -406,6 +937,169 @@ class StudentTransferDiscipline(ModelSQL, ModelView):
         else:
             return None
 
+    @classmethod
+    def set_grades(cls, grades, student_transfers=None):
+        """Create or update the grades of the (student_transfer, discipline,
+        course_classe, average) rows at once
+
+        The grades of the student_transfers missing from the rows are deleted.
+        """
+        StudentTransfer = Pool().get('akademy_matriculation.student.transfer')
+        Discipline = Pool().get('akademy_configuration.discipline')
+        CourseClasse = Pool().get('akademy_configuration.course.classe')
+
+        with Transaction().set_context(active_test=False):
+            transfers = {t.id: t for t in StudentTransfer.search([
+                        ('id', 'in', list({g[0] for g in grades}
+                                | set(student_transfers or []))),
+                        ])}
+        prefetch_fields(list(transfers.values()), ['student.course'])
+        disciplines = {d.id: d for d in Discipline.search([
+                    ('id', 'in', list({g[1] for g in grades})),
+                    ])}
+        course_classes = {c.id: c for c in CourseClasse.search([
+                    ('id', 'in', list({g[2] for g in grades})),
+                    ])}
+
+        errors, keys, averages = [], set(), {}
+        for transfer in set(student_transfers or []) - set(transfers):
+            errors.append("%s: a transferência não existe." % transfer)
+        for transfer, discipline, course_classe, average in grades:
+            name = "%s - %s" % (
+                transfers[transfer].rec_name if transfer in transfers
+                else transfer,
+                disciplines[discipline].rec_name if discipline in disciplines
+                else discipline)
+            key = (transfer, discipline, course_classe)
+            if transfer not in transfers:
+                errors.append(name+": a transferência não existe.")
+                continue
+            elif discipline not in disciplines:
+                errors.append(name+": a disciplina não existe.")
+                continue
+            elif course_classe not in course_classes:
+                errors.append(name+": a classe não existe.")
+                continue
+            try:
+                average = Decimal(str(average))
+                if not average.is_finite():
+                    raise InvalidOperation
+            except InvalidOperation:
+                errors.append(name+(": a média é obrigatória." if average is None
+                        else ": a média não é válida."))
+                continue
+            if key in keys:
+                errors.append(name+": a disciplina está repetida na mesma classe.")
+            elif not 0 <= average <= 20:
+                errors.append(name+": a média deve estar entre 0 e 20.")
+            elif average != average.quantize(Decimal('0.1')):
+                errors.append(name+": a média só pode ter uma casa decimal.")
+            elif course_classes[course_classe].course != transfers[transfer].student.course:
+                errors.append(name+": a classe não pertence ao curso do discente.")
+            keys.add(key)
+            averages[key] = average
+        if errors:
+            raise UserError("Não foi possível lançar as notas:\n"+"\n".join(errors))
+
+        existing = {(g.student_transfer.id, g.discipline.id, g.course_classe.id): g
+            for g in cls.search([('student_transfer', 'in', list(transfers))])}
+        to_delete = [g for k, g in existing.items()
+            if k[0] in (student_transfers or []) and k not in averages]
+        if to_delete:
+            cls.delete(to_delete)
+        to_create, to_write = [], {}
+        for key, average in averages.items():
+            if key in existing:
+                if existing[key].average != average:
+                    to_write.setdefault(average, []).append(existing[key])
+            else:
+                transfer, discipline, course_classe = key
+                to_create.append({
+                    'student_transfer': transfer,
+                    'discipline': discipline,
+                    'course_classe': course_classe,
+                    'average': average,
+                })
+        if to_write:
+            args = []
+            for average, records in to_write.items():
+                args.extend((records, {'average': average}))
+            cls.write(*args)
+        created = cls.create(to_create) if to_create else []
+        created = {(c.student_transfer.id, c.discipline.id, c.course_classe.id): c
+            for c in created}
+        return [existing.get(k) or created[k] for k in averages]
+
+
+class StudentTransferGrade(ModelView):
+    'Student Transfer Grade'
+    __name__ = 'akademy_matriculation.student.transfer.grade'
+
+    course = fields.Function(
+		fields.Integer(
+			'Curso',
+		), 'on_change_with_course')
+    student_transfer = fields.Many2One('akademy_matriculation.student.transfer', 
+        'Discente', required=True)
+    discipline = fields.Many2One('akademy_configuration.discipline', 
+        'Disciplina', required=True)
+    course_classe = fields.Many2One('akademy_configuration.course.classe', 'Classe', 
+        required=True, domain=[('course.id', '=', Eval('course', -1))],
+        depends=['course'])
+    average = fields.Numeric('Média', digits=(2,1), required=True)
+
+    @fields.depends('student_transfer')
+    def on_change_with_course(self, name=None):
+        if self.student_transfer:
+            return self.student_transfer.student.course.id
+        else:
+            return None
+
+
+class StudentTransferGradesStart(ModelView):
+    'Student Transfer Grades Start'
+    __name__ = 'akademy_matriculation.student.transfer.grades.start'
+
+    grades = fields.One2Many('akademy_matriculation.student.transfer.grade',
+        None, 'Notas', help="Notas da escola de origem, uma linha por disciplina e classe.")
+
+
+class StudentTransferGrades(Wizard):
+    'Student Transfer Grades'
+    __name__ = 'akademy_matriculation.student.transfer.grades'
+
+    start_state = 'start'
+    start = StateView(
+        'akademy_matriculation.student.transfer.grades.start',
+        'akademy_matriculation.student_transfer_grades_start_view_form', [
+            Button(string=u'Cancelar', state='end', icon='tryton-cancel'),
+            Button(string=u'Lançar', state='save', icon='tryton-ok', default=True)
+        ]
+    )
+    save = StateTransition()
+
+    def default_start(self, fields):
+        StudentTransferDiscipline = Pool().get('akademy_matriculation.student.transfer.discipline')
+        grades = StudentTransferDiscipline.search([
+            ('student_transfer', 'in', [r.id for r in self.records]),
+            ], order=[('student_transfer', 'ASC'), ('course_classe', 'ASC'), ('id', 'ASC')])
+        return {
+            'grades': [{
+                    'student_transfer': g.student_transfer.id,
+                    'discipline': g.discipline.id,
+                    'course_classe': g.course_classe.id,
+                    'average': g.average,
+                    } for g in grades],
+            }
+
+    @metrics.timed('akademy_wizard_seconds')
+    def transition_save(self):
+        StudentTransferDiscipline = Pool().get('akademy_matriculation.student.transfer.discipline')
+        StudentTransferDiscipline.set_grades([
+                (g.student_transfer.id, g.discipline.id, g.course_classe.id, g.average)
+                for g in self.start.grades], [r.id for r in self.records])
+        return 'end'
+
 
 class MatriculationCreateWzardStart(ModelView):
     'Matriculation CreateStart'
@@ -414,15 +1108,28 @@ class MatriculationCreateWzardStart(ModelView):
     is_candidate = fields.Boolean(
         'Candidato', 
         states={
-            'invisible':  Bool(Eval('is_transferred')) | Bool(Eval('is_student'))
-        }, depends=['is_transferred'], 
+            'invisible':  Bool(Eval('is_transferred')) | Bool(Eval('is_student')) | Bool(Eval('is_batch'))
+        }, depends=['is_transferred', 'is_batch'], 
         help="Matrícula para candidato.")
     is_transferred = fields.Boolean(
         'Transferido', 
         states={
-            'invisible':  Bool(Eval('is_candidate')) | Bool(Eval('is_student'))
-        }, depends=['is_candidate'], 
+            'invisible':  Bool(Eval('is_candidate')) | Bool(Eval('is_student')) | Bool(Eval('is_batch'))
+        }, depends=['is_candidate', 'is_batch'], 
         help="Matrícula para discente transferido.")
+    is_batch = fields.Boolean(
+        'Admitidos do critério', 
+        states={
+            'invisible':  Bool(Eval('is_candidate')) | Bool(Eval('is_transferred'))
+        }, depends=['is_candidate', 'is_transferred'], 
+        help="Matrícula de todos os candidatos admitidos num critério de admissão.")
+    applications_criteria = fields.Many2One(
+        'akademy_configuration.application.criteria', 'Critério de admissão',
+        states={
+            'invisible': Not(Bool(Eval('is_batch'))), 
+            'required': Bool(Eval('is_batch'))
+        }, depends=['is_batch'],
+        help="Caro utilizador serão matriculados os candidatos admitidos neste critério.")
     applications = fields.Many2One(
         'akademy_matriculation.applications.result', 'Candidato',
         states={
@@ -452,8 +1159,25 @@ class MatriculationCreateWzard(Wizard):
         ]
     )
     matriculation = StateTransition()
+    errors = StateView(
+        'akademy_matriculation.batch.errors',
+        "akademy_matriculation.batch_errors_view_form", [
+            Button(string=u'Fechar', state='end', icon='tryton-close')
+        ]
+    )
 
+    @metrics.timed('akademy_wizard_seconds')
     def transition_matriculation(self):       
+        if self.start.is_batch:
+            BatchErrors = Pool().get('akademy_matriculation.batch.errors')
+            processed, errors = MatriculationCreateWzard.candidates_matriculation(
+                self.start.applications_criteria)
+            if errors:
+                self.errors.processed = processed
+                self.errors.failed = len(errors)
+                self.errors.errors = BatchErrors.format(errors)
+                return 'errors'
+            return 'end'
         if (self.start.is_candidate == True):
             MatriculationCreateWzard.student_candidate(self.start.applications.application)
         if (self.start.is_transferred == True):
@@ -461,13 +1185,100 @@ class MatriculationCreateWzard(Wizard):
                     
         return 'end'
     
+    def default_errors(self, fields):
+        return {
+            'processed': self.errors.processed,
+            'failed': self.errors.failed,
+            'errors': self.errors.errors,
+            }
+
+    @classmethod
+    def candidates_matriculation(cls, criteria):
+        "Matriculate the valid admitted candidates of the criteria and return the errors of the others"
+        ApplicationResult = Pool().get('akademy_matriculation.applications.result')
+
+        Notification = Pool().get('akademy_matriculation.notification')
+
+        results = ApplicationResult.search([
+            ('application_criteria', '=', criteria),
+            ('result', '=', 'Admitido'),
+            ])
+        invalid = MatriculationCreateWzard.check_candidates(results)
+        processed = 0
+        notifications = []
+        for result in results:
+            if result.id not in invalid:
+                MatriculationCreateWzard.student_candidate(result.application, notifications)
+                processed += 1
+        Notification.flush(notifications)
+        return processed, [(r.rec_name, invalid[r.id]) for r in results if r.id in invalid]
+
+    @classmethod
+    def check_candidates(cls, results):
+        "Return the error message of each admitted result which can not be matriculated"
+        Classes = Pool().get('akademy_classe.classes')
+        ClasseStudent = Pool().get('akademy_classe.classe.student')
+        SeatReservation = Pool().get('akademy_matriculation.seat.reservation')
+
+        applications = [r.application for r in results]
+        if not applications:
+            return {}
+        prefetch_fields(applications, ['candidate.party', 'area.studyplan',
+                'course_classe.classe', 'lective_year', 'course'])
+        lective_years = list({a.lective_year.id for a in applications})
+
+        matriculated = {(c.student.party.id, c.classes.lective_year.id)
+            for c in ClasseStudent.search([
+                    ('student.party', 'in', list({a.candidate.party.id for a in applications})),
+                    ('classes.lective_year', 'in', lective_years),
+                    ])}
+        classes_by_key = {}
+        for classes in Classes.search([
+                    ('lective_year', 'in', lective_years),
+                    ('classe', 'in', list({a.course_classe.classe.id for a in applications})),
+                    ('studyplan.course', 'in', list({a.course.id for a in applications})),
+                    ]):
+            key = (classes.lective_year.id, classes.classe.id, classes.studyplan.course.id)
+            classes_by_key.setdefault(key, []).append(classes)
+        open_classes = [c for l in classes_by_key.values() for c in l if c.state == False]
+        occupancy = ClasseAllocator.get_occupancy(open_classes)
+        free_seats = {key: sum(
+                max(ClasseAllocator.get_free_seats(c, occupancy[c.id]), 0)
+                for c in l if c.state == False)
+            for key, l in classes_by_key.items()}
+        held = {r.application_result.id for r in SeatReservation.search([
+                    ('application_result', 'in', [r.id for r in results]),
+                    ('state', '=', 'held'),
+                    ('expiration', '>', datetime.now()),
+                    ])}
+
+        errors = {}
+        for result, application in zip(results, applications):
+            key = (application.lective_year.id, application.course_classe.classe.id, application.course.id)
+            if (application.candidate.party.id, application.lective_year.id) in matriculated:
+                errors[result.id] = "O candidato já está matriculado neste ano letivo."
+            elif not application.area.studyplan:
+                errors[result.id] = "A área ainda não possui planos de estudos."
+            elif not classes_by_key.get(key):
+                errors[result.id] = "Ainda não existe uma turma criada."
+            elif not any(c.state == False for c in classes_by_key[key]):
+                errors[result.id] = "A turma já se encontra fechada."
+            elif result.id in held:
+                # The held seat is already counted in the occupancy
+                pass
+            elif free_seats[key] <= 0:
+                errors[result.id] = "Excedeu o limite de vagas disponíveis."
+            else:
+                free_seats[key] -= 1
+        return errors
+
     @classmethod
-    def student_candidate(cls, application):
+    def student_candidate(cls, application, notifications=None):
         NewStudent = Pool().get('company.student')        
         MatriculationState = Pool().get('akademy_configuration.matriculation.state')
         
         if len(application.candidate.party.student) > 0:
-            MatriculationCreateWzard.candidate_matriculation(application, application.candidate.party.student[0], 'Candidato(a)')          
+            MatriculationCreateWzard.candidate_matriculation(application, application.candidate.party.student[0], 'Candidato(a)', notifications)          
         else:
             student_matriculatio = NewStudent.search([
                 ('party','=',application.candidate.party),
@@ -482,50 +1293,65 @@ class MatriculationCreateWzard(Wizard):
                 Matriculation = NewStudent(
                     state = matriculation_state[0],
                     course = application.course,
-                    area = studapplicationent.area,
+                    area = application.area,
                     academic_level = application.academic_level,
                     start_date = date.today(),
                     party = application.candidate.party,
                 )
                 Matriculation.save()
 
-                MatriculationCreateWzard.candidate_matriculation(application, Matriculation, 'Candidato(a)')        
+                MatriculationCreateWzard.candidate_matriculation(application, Matriculation, 'Candidato(a)', notifications)        
         
     @classmethod
-    def candidate_matriculation(cls, application, matriculation, type):
+    def candidate_matriculation(cls, application, matriculation, type, notifications=None):
         ClasseStudent = Pool().get('akademy_classe.classe.student')
         Classes = Pool().get('akademy_classe.classes')
         MatriculationState = Pool().get('akademy_configuration.matriculation.state')
         MatriculationType = Pool().get('akademy_configuration.matriculation.type')        
+        SeatReservation = Pool().get('akademy_matriculation.seat.reservation')
+        Notification = Pool().get('akademy_matriculation.notification')
         
         if len(application.area.studyplan) <= 0:
             raise UserError("Infelizmente, não é possível matricular o discente, pois a área ainda não possui planos de estudos.")
 
-        get_classes = Classes.search([
-            ('lective_year', '=', application.lective_year),
-            ('classe', '=', application.course_classe.classe),
-            ('studyplan.course', '=', application.course),
-            ])
-
-        if len(get_classes) > 0:
-            if get_classes[0].state == False:
-                if (get_classes[0].max_student != len(get_classes[0].classe_student)):
-                    matriculation_state = MatriculationState.search([('name', '=', 'Matrículado(a)')], limit=1)
-                    matriculation_type = MatriculationType.search([('name', '=', type)], limit=1)                                                
-                    MatriculationStudent = MatriculationCreateWzard.create_student_matriculation(
-                        application, ClasseStudent, matriculation_state[0], matriculation_type[0], 
-                        matriculation, get_classes[0], get_classes[0].classe, 0
-                    )
-                    
-                    if len(application.area.studyplan[0].studyplan_discipline) > 0:
-                        MatriculationCreateWzard.discipline_matriculation(MatriculationStudent, get_classes[0].studyplan.studyplan_discipline) 
+        # The seat held at admission is taken without counting the classes
+        reservation = SeatReservation.get_held(application)
+        if reservation and reservation.classes.state == False:
+            SeatReservation.consume([reservation])
+            classes = reservation.classes
+        else:
+            get_classes = Classes.search([
+                ('lective_year', '=', application.lective_year),
+                ('classe', '=', application.course_classe.classe),
+                ('studyplan.course', '=', application.course),
+                ])
+            if len(get_classes) <= 0:
+                raise UserError("Não foi possível efetuar a matrícula do discente ou candidato, porque ainda não existe uma turma criada.")      
 
-                else:
-                    raise UserError("Infelizmente não é possível matricular o discente, porque ja excedeu o limite de vagas disponíveis.")
-            else:
+            allocator = ClasseAllocator(get_classes)
+            if not allocator.classes:
                 raise UserError("Não é possível efetuar a matrícula do discente ou candidato, porque a turma já se encontra fechada.")
+
+            classes = allocator.allocate()
+            if not classes:
+                raise UserError("Infelizmente não é possível matricular o discente, porque ja excedeu o limite de vagas disponíveis.")
+
+        matriculation_state = MatriculationState.search([('name', '=', 'Matrículado(a)')], limit=1)
+        matriculation_type = MatriculationType.search([('name', '=', type)], limit=1)                                                
+        MatriculationStudent = MatriculationCreateWzard.create_student_matriculation(
+            application, ClasseStudent, matriculation_state[0], matriculation_type[0], 
+            matriculation, classes, classes.classe, 0
+        )
+        
+        if len(application.area.studyplan[0].studyplan_discipline) > 0:
+            MatriculationCreateWzard.discipline_matriculation(MatriculationStudent, classes.studyplan.studyplan_discipline) 
+        metrics.inc('akademy_matriculations_total', model=cls.__name__, type=type)
+
+        values = Notification.get_values('matriculation', application, classes=classes)
+        if notifications is not None:
+            notifications.append(values)
         else:
-            raise UserError("Não foi possível efetuar a matrícula do discente ou candidato, porque ainda não existe uma turma criada.")      
+            Notification.flush([values])
     
     @classmethod
     def create_student_matriculation(cls, classe_student, ClasseStudent, matriculation_state, matriculation_type, student, classes, classe, update):   
@@ -631,43 +1457,45 @@ class MatriculationCreateWzard(Wizard):
             ('studyplan', '=', studyplan)
             ])
 
-        if get_classes[0].state == False: 
+        if len(get_classes) <= 0:
+            raise UserError("Infelizmente não é possível matricular o discente, porque não foi encontrado um encontrado uma turma disponivel.")
+
+        allocator = ClasseAllocator(get_classes)
+        if allocator.classes: 
             if len(student.student.classe_student) > 0:
                 raise UserError("Infelizmente não é possível matricular o discente, porque o discente já está matriculado.")                    
             else:
-                if len(get_classes) > 0:                        
-                    get_class_student = ClasseStudent.search(
-                        [
-                            ('student', '=', student.student),
-                            ('classes', '=', get_classes[0])
-                        ]
-                    ) 
-                    
-                    if len(get_class_student) > 0:
-                        raise UserError("O discente "+student.student.party.name+" já existe na instituição, por favor verifique a matrícula na "+get_class_student[0].classes.name+".")                        
-                    else:
-                        if (get_classes[0].max_student != len(get_classes[0].classe_student)):
-                            matriculation_state = MatriculationState.search([('name', '=', 'Matrículado(a)')], limit=1)
-                            matriculation_type = MatriculationType.search([('name', '=', 'Transfêrido(a)')], limit=1)
-
-                            MatriculationCreateWzard.create_student_matriculation(student, ClasseStudent, matriculation_state[0], matriculation_type[0], student.student, get_classes[0], get_classes[0].classe, 0)                                                        
-                            student_matriculation = Student.search([
-                                ('party','=',student.student.party),
-                                ('academic_level','=',student.student.academic_level),
-                                ('area','=',student.student.area),
-                                ('course','=',student.student.course)
-                                ])
-                            
-                            if len(student_matriculation) > 0:
-                                state = MatriculationState.search([('name', '=', 'Matrículado(a)')], limit=1)
-                                student_matriculation[0].state = state[0]
-                                student_matriculation[0].save()
-                                                        
-                            MatriculationCreateWzard.student_transferred_discipline(student.student.classe_student, get_student_transferred_discipline, get_classes[0].studyplan)
-                        else:
-                            raise UserError("Infelizmente não é possível matricular o discente, porque ja excedeu o limite de vagas disponíveis.")
+                get_class_student = ClasseStudent.search(
+                    [
+                        ('student', '=', student.student),
+                        ('classes', 'in', get_classes)
+                    ], limit=1
+                ) 
+                
+                if len(get_class_student) > 0:
+                    raise UserError("O discente "+student.student.party.name+" já existe na instituição, por favor verifique a matrícula na "+get_class_student[0].classes.name+".")                        
                 else:
-                    raise UserError("Infelizmente não é possível matricular o discente, porque não foi encontrado um encontrado uma turma disponivel.")           
+                    classes = allocator.allocate()
+                    if classes:
+                        matriculation_state = MatriculationState.search([('name', '=', 'Matrículado(a)')], limit=1)
+                        matriculation_type = MatriculationType.search([('name', '=', 'Transfêrido(a)')], limit=1)
+
+                        MatriculationCreateWzard.create_student_matriculation(student, ClasseStudent, matriculation_state[0], matriculation_type[0], student.student, classes, classes.classe, 0)                                                        
+                        student_matriculation = Student.search([
+                            ('party','=',student.student.party),
+                            ('academic_level','=',student.student.academic_level),
+                            ('area','=',student.student.area),
+                            ('course','=',student.student.course)
+                            ])
+                        
+                        if len(student_matriculation) > 0:
+                            state = MatriculationState.search([('name', '=', 'Matrículado(a)')], limit=1)
+                            student_matriculation[0].state = state[0]
+                            student_matriculation[0].save()
+                                                    
+                        MatriculationCreateWzard.student_transferred_discipline(student.student.classe_student, get_student_transferred_discipline, classes.studyplan)
+                    else:
+                        raise UserError("Infelizmente não é possível matricular o discente, porque ja excedeu o limite de vagas disponíveis.")
     
         else:
             raise UserError("Não é possível efetuar a matrícula do discente ou candidato, porque a turma já se encontra fechada.")
@@ -713,6 +1541,12 @@ class AssociationDisciplineCreateWzardStart(ModelView):
         'akademy_classe.classes', 'Turma', required=True,
         help="Caro utilizador será feita uma associação entre os discentes desta turma e as displinas existentes no plano de estudo."
     )
+    collect_errors = fields.Boolean('Reunir erros',
+        help="Associar os discentes válidos e apresentar no fim os que não foram associados.")
+
+    @classmethod
+    def default_collect_errors(cls):
+        return False
 
 
 class AssociationDisciplineCreateWzard(Wizard):
@@ -728,33 +1562,54 @@ class AssociationDisciplineCreateWzard(Wizard):
         ]
     )
     association = StateTransition()
+    errors = StateView(
+        'akademy_matriculation.batch.errors',
+        "akademy_matriculation.batch_errors_view_form", [
+            Button(string=u'Fechar', state='end', icon='tryton-close')
+        ]
+    )
 
+    @metrics.timed('akademy_wizard_seconds')
     def transition_association(self):
-        StudentDiscipline = Pool().get('akademy_classe.classe.student.discipline')
-        DisciplineModality = Pool().get('akademy_configuration.discipline.modality')
-
-        state_student = ['Aguardando', 'Suspenso(a)', 'Anulada', 'Transfêrido(a)', 'Reprovado(a)']
-        list_matriculation = 0
-
-        if self.start.classes.state == False:
-            for classe_student in self.start.classes.classe_student:
-                if classe_student.state.name not in state_student:
-                    for studyplan_discipline in self.start.classes.studyplan.studyplan_discipline:
-                        matriculaton_discipline = StudentDiscipline.search(
-                            [('classe_student', '=', classe_student), ('studyplan_discipline', '=', studyplan_discipline)]
-                        )
-                        
-                        if (len(matriculaton_discipline) < 1):
-                            list_matriculation = 1
-                            discipline_modality = DisciplineModality.search([('name', '=', "Presencial")], limit=1)
-
-                            matriculaton = StudentDiscipline(
-                                classe_student = classe_student,
-                                studyplan_discipline = studyplan_discipline,
-                                state = classe_student.state,
-                                modality = discipline_modality[0]
-                            )
-                            matriculaton.save()
+        BatchRun = Pool().get('akademy_matriculation.batch.run')
+        BatchErrors = Pool().get('akademy_matriculation.batch.errors')
+        ClasseStudent = Pool().get('akademy_classe.classe.student')
+        classes = self.start.classes
+
+        if self.start.collect_errors:
+            errors = []
+            if classes.state != False:
+                errors.append((classes.rec_name, "A turma já se encontra fechada."))
+            elif not classes.studyplan.studyplan_discipline:
+                errors.append((classes.rec_name, "O plano de estudo da turma não tem disciplinas."))
+            if errors:
+                classe_students = []
+            else:
+                # The students in a state which is not associated are reported at once
+                errors.extend((c.rec_name, "O discente encontra-se no estado "+c.state.name+".")
+                    for c in ClasseStudent.search([
+                            ('classes', '=', classes.id),
+                            ('state.name', 'in', state_student_not_associated),
+                            ]))
+                classe_students = list(iter_ids(ClasseStudent, [
+                    ('classes', '=', classes.id),
+                    ('state.name', 'not in', state_student_not_associated),
+                    ]))
+            BatchRun.execute(
+                'association', classes, classe_students,
+                AssociationDisciplineCreateWzard.associate_students)
+            if errors:
+                self.errors.processed = len(classe_students)
+                self.errors.failed = len(errors)
+                self.errors.errors = BatchErrors.format(errors)
+                return 'errors'
+            return 'end'
+
+        if classes.state == False:
+            list_matriculation = BatchRun.execute(
+                'association', classes,
+                list(iter_ids(ClasseStudent, [('classes', '=', classes.id)])),
+                AssociationDisciplineCreateWzard.associate_students)
 
             if list_matriculation == 0:
                 raise UserError("Não foi possível associar disciplinas aos discentes desta turma, por favor verificar se a turma tem discentes ou se todas as disciplinas já foram associadas.")		
@@ -764,6 +1619,42 @@ class AssociationDisciplineCreateWzard(Wizard):
                     
         return 'end'  
 
+    def default_errors(self, fields):
+        return {
+            'processed': self.errors.processed,
+            'failed': self.errors.failed,
+            'errors': self.errors.errors,
+            }
+
+    @classmethod
+    def associate_students(cls, classe_student_ids):
+        ClasseStudent = Pool().get('akademy_classe.classe.student')
+        StudentDiscipline = Pool().get('akademy_classe.classe.student.discipline')
+        DisciplineModality = Pool().get('akademy_configuration.discipline.modality')
+
+        discipline_modality = DisciplineModality.search([('name', '=', "Presencial")], limit=1)
+
+        classe_students = ClasseStudent.browse(classe_student_ids)
+        prefetch_fields(classe_students, ['state', 'classes.studyplan.studyplan_discipline'])
+        matriculaton_discipline = {
+            (d.classe_student.id, d.studyplan_discipline.id)
+            for d in StudentDiscipline.search([('classe_student', 'in', classe_student_ids)])}
+
+        matriculaton = []
+        for classe_student in classe_students:
+            if classe_student.state.name not in state_student_not_associated:
+                for studyplan_discipline in classe_student.classes.studyplan.studyplan_discipline:
+                    if (classe_student.id, studyplan_discipline.id) not in matriculaton_discipline:
+                        matriculaton.append({
+                            'classe_student': classe_student.id,
+                            'studyplan_discipline': studyplan_discipline.id,
+                            'state': classe_student.state.id,
+                            'modality': discipline_modality[0].id,
+                        })
+        StudentDiscipline.create(matriculaton)
+
+        return len(matriculaton)
+
 
 class ApplicationAvaliationCreateWzardStart(ModelView):
     "ApplicationAvaliation CreateStart"
@@ -772,6 +1663,24 @@ class ApplicationAvaliationCreateWzardStart(ModelView):
     applications_criteria = fields.Many2One(
         'akademy_configuration.application.criteria', 'Critério de admissão',       
         required=True, help="Caro utilizador escolha o critério de admissão.")
+    incremental = fields.Boolean('Apenas por avaliar',
+        help="Avaliar apenas as candidaturas ainda não avaliadas neste critério.")
+    collect_errors = fields.Boolean('Reunir erros',
+        help="Avaliar as candidaturas válidas e apresentar no fim os erros de todas as outras.")
+    company = fields.Many2One('company.company', 'Escola', required=True,
+        help="Escola cujas candidaturas serão avaliadas.")
+
+    @staticmethod
+    def default_company():
+        return Transaction().context.get('company')
+
+    @classmethod
+    def default_incremental(cls):
+        return True
+
+    @classmethod
+    def default_collect_errors(cls):
+        return False
 
 
 class ApplicationAvaliationCreateWzard(Wizard):
@@ -787,62 +1696,174 @@ class ApplicationAvaliationCreateWzard(Wizard):
         ]
     )
     application_avaliation = StateTransition()
+    errors = StateView(
+        'akademy_matriculation.batch.errors',
+        "akademy_matriculation.batch_errors_view_form", [
+            Button(string=u'Fechar', state='end', icon='tryton-close')
+        ]
+    )
 
+    @metrics.timed('akademy_wizard_seconds')
     def transition_application_avaliation(self):
+        # The ranking, the seats and the batch run are those of the school
+        with Transaction().set_context(company=self.start.company.id):
+            return self.application_avaliation_company()
+
+    def application_avaliation_company(self):
         Criteria = Pool().get('akademy_configuration.application.criteria')
-        ApplicationResult = Pool().get('akademy_matriculation.applications.result') 
+        BatchErrors = Pool().get('akademy_matriculation.batch.errors')
         Applications = Pool().get('akademy_matriculation.applications') 
+        BatchRun = Pool().get('akademy_matriculation.batch.run')
         
-        candidate_application = Applications.search([
+        domain = [
+            ('company', '=', self.start.company),
             ('phase', '=', self.start.applications_criteria.phase),
             ('lective_year', '=', self.start.applications_criteria.lective_year),
             ('academic_level', '=', self.start.applications_criteria.academic_level),
             ('area', '=', self.start.applications_criteria.area),
             ('course', '=', self.start.applications_criteria.course)
-            ])
+            ]
+        if self.start.incremental:
+            domain.extend([
+                ('state', '=', False),
+                ('result', 'not where', [
+                    ('application_criteria', '=', self.start.applications_criteria.id),
+                    ]),
+                ])
+        candidate_application = list(iter_ids(Applications, domain))
         
         if self.start.applications_criteria.phase.start <= date.today() <= self.start.applications_criteria.phase.end:
             if len(candidate_application) >= 1:
-                #application_sorted = []
-                #for value in candidate_application:
-                #    application_sorted.append(value)                
-
-                #application_sort = sorted(application_sorted, key=lambda application_sort: [application_sort.age, application_sort.candidate.average])           
-
-                order = [('age', 'ASC'), ('candidate.average', 'ASC')]
-                application_sort = sort(candidate_application, order)
+                # Ranked applications first, the ones below the criteria after
+                ranking = Criteria.get_ranking(
+                    [self.start.applications_criteria]
+                    )[self.start.applications_criteria.id]
+                pending = set(candidate_application)
+                ranked = set(ranking)
+                application_sort = [i for i in ranking if i in pending] + [
+                    i for i in candidate_application if i not in ranked]
                 
-                for element in application_sort:                
-                    phase_admission = element.phase
-                    ApplicationCriteria = Criteria.search([('course', '=', element.course), ('phase', '=', phase_admission)])                  
-                    
-                    if len(ApplicationCriteria) > 0:
-                        Result = ApplicationResult.search([
-                            ('result', '=', 'Admitido'), 
-                            ('application_criteria', '=', ApplicationCriteria[0]),
-                            ('lective_year', '=', element.lective_year)
-                            ]) 
-                    
-                        limit = len(Result)
-                        if len(ApplicationCriteria) >= 1:
-                            if ApplicationCriteria[0].student_limit >= limit: 
-                                if len(element.result) <= 1:
-                                    Applications.application_admission_avaliation(ApplicationCriteria, element, ApplicationResult, element.lective_year)
-                                else:
-                                    raise UserError("Não foi possível avaliar a candidatura do candidato(a) "+element.candidate.party.name+
-                                                    ", por favor verificar se já existe uma candidatura avaliada para o mesmo.")
-                            else:
-                                raise UserError("Não foi possível avaliar a candidatura, porque já excedeu o limit estabelecido pela instituição.")
-                        else:
-                            raise UserError("Não foi possível avaliar a candidatura. Por favor, verifique se existe pelo menos um critério de admissão na fase "+
-                                            element.phase.name+", para o curso de "+element.course.name+".\nOu se o candidato(a) "+element.candidate.party.name+
-                                            ", já possui uma candidatura para neste curso e neste ano letivo.")
-                    else:
-                        raise UserError("Não foi possível avaliar a candidatura, porque não foi possível encontrar um critério de admissão,"+
-                                        " para a fase "+self.start.applications_criteria.phase.name)
+                if self.start.collect_errors:
+                    invalid = Applications.check_evaluation(application_sort)
+                    errors = [(Applications(i).rec_name, invalid[i])
+                        for i in application_sort if i in invalid]
+                    application_sort = [
+                        i for i in application_sort if i not in invalid]
+                    checked = len(errors)
+                    BatchRun.execute(
+                        'avaliation', self.start.applications_criteria,
+                        application_sort,
+                        partial(ApplicationAvaliationCreateWzard.evaluate_applications,
+                            errors=errors,
+                            allocation=self.get_allocation(application_sort)))
+                    if errors:
+                        self.errors.processed = (
+                            len(application_sort) - (len(errors) - checked))
+                        self.errors.failed = len(errors)
+                        self.errors.errors = BatchErrors.format(errors)
+                        return 'errors'
+                else:
+                    BatchRun.execute(
+                        'avaliation', self.start.applications_criteria,
+                        application_sort,
+                        partial(ApplicationAvaliationCreateWzard.evaluate_applications,
+                            allocation=self.get_allocation(application_sort)))
         else:
             raise UserError("Não foi possível avaliar a candidatura, porque já se encontra fora do período de avaliação de candidatura da fase "+
                             self.start.applications_criteria.phase.name)
     
         return 'end'
-        
+
+    def default_errors(self, fields):
+        return {
+            'processed': self.errors.processed,
+            'failed': self.errors.failed,
+            'errors': self.errors.errors,
+            }
+
+    def get_allocation(self, application_ids):
+        "Allocate the seats to all the applications before they are chunked"
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        criterias = Criteria.search([
+            ('course', '=', self.start.applications_criteria.course),
+            ('phase', '=', self.start.applications_criteria.phase),
+            ])
+        Criteria.compute_scores(criterias, application_ids)
+        return {c: {a for a, _ in rows} for c, rows in
+            Criteria.allocate(criterias, application_ids).items()}
+
+    @classmethod
+    def evaluate_applications(cls, application_ids, errors=None, allocation=None):
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        ApplicationResult = Pool().get('akademy_matriculation.applications.result') 
+        Applications = Pool().get('akademy_matriculation.applications') 
+        Decision = Pool().get('akademy_matriculation.admission.decision')
+        Notification = Pool().get('akademy_matriculation.notification')
+
+        def fail(application, message):
+            if errors is None:
+                raise UserError(message)
+            errors.append((application.rec_name, message))
+
+        applications = Applications.browse(application_ids)
+        prefetch_fields(applications, ['candidate.party', 'phase', 'course', 'result'])
+        all_criterias = Criteria.search([
+            ('course', 'in', list({a.course.id for a in applications})),
+            ('phase', 'in', list({a.phase.id for a in applications})),
+            ])
+        if allocation is None:
+            Criteria.compute_scores(all_criterias, applications)
+        ranks = Applications.get_rank(applications, ['rank'])['rank']
+        if allocation is None:
+            allocation = {c: {a for a, _ in rows} for c, rows in
+                Criteria.allocate(all_criterias, applications).items()}
+        decisions = []
+        notifications = []
+        criterias = {}
+        for element in applications:                
+            phase_admission = element.phase
+            key = (element.course.id, phase_admission.id)
+            if key not in criterias:
+                criterias[key] = Criteria.search([('course', '=', element.course), ('phase', '=', phase_admission)])                  
+            ApplicationCriteria = criterias[key]
+            
+            if len(ApplicationCriteria) <= 0:
+                fail(element, "Não foi possível avaliar a candidatura, porque não foi possível encontrar um critério de admissão,"+
+                                " para a fase "+element.phase.name)
+                continue
+
+            limit = ApplicationResult.search_count([
+                ('company', '=', element.company),
+                ('result', '=', 'Admitido'), 
+                ('application_criteria', '=', ApplicationCriteria[0]),
+                ('lective_year', '=', element.lective_year)
+                ]) 
+            if ApplicationCriteria[0].student_limit < limit:
+                fail(element, "Não foi possível avaliar a candidatura, porque já excedeu o limit estabelecido pela instituição.")
+                continue
+            if len(element.result) > 1:
+                fail(element, "Não foi possível avaliar a candidatura do candidato(a) "+element.candidate.party.name+
+                                ", por favor verificar se já existe uma candidatura avaliada para o mesmo.")
+                continue
+            Applications.application_admission_avaliation(ApplicationCriteria, element, ApplicationResult, element.lective_year,
+                decisions, ranks[element.id], notifications, allocation)
+
+        Decision.flush(decisions)
+        # The messages are sent by the cron so the evaluation does not wait
+        Notification.flush(notifications)
+        metrics.inc('akademy_evaluations_total', len(applications),
+            model=Applications.__name__)
+
+
+class CandidatesDuplicate(Wizard):
+    "Candidates Duplicate"
+    __name__ = 'akademy_matriculation.candidates.duplicate'
+
+    start_state = 'open_'
+    open_ = StateAction('akademy_matriculation.act_candidates_duplicate')
+
+    def do_open_(self, action):
+        Candidates = Pool().get('akademy_matriculation.candidates')
+        ids = [i for group in Candidates.find_duplicates() for i in group]
+        action['pyson_domain'] = PYSONEncoder().encode([('id', 'in', ids)])
+        return action, {}
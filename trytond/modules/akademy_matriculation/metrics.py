@@ -0,0 +1,186 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+import os
+import threading
+import time
+import weakref
+from collections import defaultdict
+from functools import wraps
+
+from trytond.config import config
+
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, float('inf'))
+
+HELP = {
+    'akademy_evaluations_total': "Applications evaluated",
+    'akademy_admissions_total': "Applications admitted",
+    'akademy_matriculations_total': "Students matriculated",
+    'akademy_transfers_total': "Student transfers created",
+    'akademy_notifications_total': "Notifications sent by the outbox",
+    'akademy_replica_reads_total': "Reads routed to the replica or primary",
+    'akademy_seats_remaining': "Seats remaining of the admission criteria",
+    'akademy_wizard_seconds': "Latency of the wizard transitions",
+    'akademy_report_seconds': "Latency of the reports",
+    }
+
+
+class _Shard(object):
+    "The metrics recorded by one thread"
+
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    def merge(self, shard):
+        "Add the metrics of the shard to this one"
+        for key, value in list(shard.counters.items()):
+            self.counters[key] += value
+        for key, histogram in list(shard.histograms.items()):
+            total = self.histograms.setdefault(key, [0] * len(histogram))
+            for i, value in enumerate(histogram):
+                total[i] += value
+
+
+class _Owner(object):
+    "Live in the thread-local storage as long as the thread of a shard"
+
+
+# Each thread only writes its own shard so recording needs no lock, the
+# shards are summed when the metrics are rendered. The shard of an ended
+# thread is folded into the retired one so that the shards do not grow
+# with the short-lived threads of the server.
+_local = threading.local()
+_lock = threading.Lock()
+_shards = set()
+_retired = _Shard()
+_gauges = {}
+_last_dump = [0]
+
+
+def _shard():
+    shard = getattr(_local, 'shard', None)
+    if shard is None:
+        shard = _local.shard = _Shard()
+        _local.owner = _Owner()
+        with _lock:
+            _shards.add(shard)
+        weakref.finalize(_local.owner, _retire, shard)
+    return shard
+
+
+def _retire(shard):
+    with _lock:
+        _shards.discard(shard)
+        _retired.merge(shard)
+
+
+def _key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def inc(name, value=1, **labels):
+    _shard().counters[_key(name, labels)] += value
+
+
+def set_gauge(name, value, **labels):
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    histograms = _shard().histograms
+    key = _key(name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        # bucket counts followed by the sum
+        histogram = histograms[key] = [0] * (len(BUCKETS) + 1)
+    for i, bound in enumerate(BUCKETS):
+        if value <= bound:
+            histogram[i] += 1
+            break
+    histogram[-1] += value
+    dump()
+
+
+def timed(name):
+    "Decorate a method to observe its duration under the model name"
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self_or_cls, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(self_or_cls, *args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start,
+                    model=self_or_cls.__name__, method=func.__name__)
+        return wrapper
+    return decorator
+
+
+def _format(name, labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return name
+    return '%s{%s}' % (name, ','.join(
+            '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels))
+
+
+def render():
+    "Return the metrics of all the threads in the Prometheus text format"
+    total = _Shard()
+    with _lock:
+        total.merge(_retired)
+        shards = list(_shards)
+    for shard in shards:
+        total.merge(shard)
+    counters, histograms = total.counters, total.histograms
+
+    families = defaultdict(list)
+    for (name, labels), value in sorted(counters.items()):
+        families[(name, 'counter')].append(
+            '%s %s' % (_format(name, labels), value))
+    for (name, labels), value in sorted(_gauges.items()):
+        families[(name, 'gauge')].append(
+            '%s %s' % (_format(name, labels), value))
+    for (name, labels), histogram in sorted(histograms.items()):
+        lines = families[(name, 'histogram')]
+        cumulative = 0
+        for bound, count in zip(BUCKETS, histogram):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s %s' % (
+                    _format(name + '_bucket', labels, [('le', le)]),
+                    cumulative))
+        lines.append('%s %s' % (_format(name + '_sum', labels), histogram[-1]))
+        lines.append('%s %s' % (
+                _format(name + '_count', labels), cumulative))
+
+    output = []
+    for (name, type_), lines in sorted(families.items()):
+        output.append('# HELP %s %s' % (name, HELP.get(name, name)))
+        output.append('# TYPE %s %s' % (name, type_))
+        output.extend(lines)
+    return '\n'.join(output) + '\n'
+
+
+def dump(force=False):
+    """Write the metrics to the metrics_file of the configuration
+
+    The file name may contain {pid} to get one file per worker for the
+    textfile collector. It is written at most every metrics_interval seconds.
+    """
+    path = config.get('akademy_matriculation', 'metrics_file', default='')
+    if not path:
+        return
+    interval = config.getint(
+        'akademy_matriculation', 'metrics_interval', default=15)
+    now = time.monotonic()
+    if not force and now - _last_dump[0] < interval:
+        return
+    _last_dump[0] = now
+    path = path.format(pid=os.getpid())
+    tmp = '%s.%s.tmp' % (path, threading.get_ident())
+    with open(tmp, 'w') as file:
+        file.write(render())
+    os.replace(tmp, path)
@@ -0,0 +1,246 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+import logging
+import time
+from datetime import datetime, timedelta
+from email.message import EmailMessage
+from importlib import import_module
+
+from trytond.backend import DatabaseOperationalError
+from trytond.config import config
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.pyson import Eval
+from trytond.sendmail import get_smtp_server, sendmail
+from trytond.transaction import Transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+sel_notification_kind = [
+    ('admission', 'Resultado da candidatura'),
+    ('matriculation', 'Matrícula'),
+]
+
+sel_notification_state = [
+    ('pending', 'Por enviar'),
+    ('sent', 'Enviada'),
+    ('failed', 'Falhou'),
+]
+
+MESSAGES = {
+    'admission': (
+        "Resultado da candidatura",
+        "Caro(a) {name},\n\nA sua candidatura ao curso de {course} "
+        "foi avaliada com o resultado: {result}.\n"),
+    'matriculation': (
+        "Matrícula efetuada",
+        "Caro(a) {name},\n\nA sua matrícula no curso de {course} "
+        "foi efetuada na turma {classes}.\n"),
+}
+
+
+class SMTPSender(object):
+    "Send the messages on one connection to the SMTP server"
+
+    def __init__(self, uri=None):
+        self.uri = uri
+        self.server = None
+
+    def __enter__(self):
+        self.server = get_smtp_server(self.uri)
+        return self
+
+    def __exit__(self, *args):
+        self.server.quit()
+
+    def send(self, to_addr, subject, body):
+        from_addr = config.get('email', 'from')
+        message = EmailMessage()
+        message['From'] = from_addr
+        message['To'] = to_addr
+        message['Subject'] = subject
+        message.set_content(body)
+        sendmail(from_addr, [to_addr], message, server=self.server)
+
+
+class LogSender(object):
+    "Write the messages to the log instead of sending them"
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, to_addr, subject, body):
+        logger.info("notification to %s: %s", to_addr, subject)
+
+
+SENDERS = {
+    'smtp': SMTPSender,
+    'log': LogSender,
+    }
+
+
+def get_sender():
+    "Return the sender of the configuration, a name or a dotted class path"
+    name = config.get(
+        'akademy_matriculation', 'notification_sender', default='smtp')
+    if name in SENDERS:
+        return SENDERS[name]()
+    module, _, attribute = name.rpartition('.')
+    return getattr(import_module(module), attribute)()
+
+
+class Notification(ModelSQL, ModelView):
+    'Notification'
+    __name__ = 'akademy_matriculation.notification'
+
+    kind = fields.Selection(sel_notification_kind, 'Tipo',
+        required=True, readonly=True)
+    party = fields.Many2One('party.party', 'Destinatário',
+        required=True, readonly=True, ondelete="CASCADE")
+    application = fields.Many2One('akademy_matriculation.applications',
+        'Candidatura', readonly=True, ondelete="CASCADE")
+    result = fields.Char('Resultado', readonly=True)
+    classes = fields.Many2One('akademy_classe.classes', 'Turma',
+        readonly=True, ondelete="SET NULL")
+    company = fields.Many2One('company.company', 'Escola', readonly=True)
+    state = fields.Selection(sel_notification_state, 'Estado',
+        required=True, readonly=True)
+    attempts = fields.Integer('Tentativas', readonly=True)
+    next_attempt = fields.DateTime('Próxima tentativa', readonly=True)
+    sent = fields.DateTime('Enviada em', readonly=True)
+    message = fields.Text('Erro', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Notification, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table,
+                (table.next_attempt, Index.Range()),
+                (table.id, Index.Range()),
+                where=table.state == 'pending'),
+        })
+        cls._order = [('create_date', 'DESC')]
+        cls._buttons.update({
+                'retry': {
+                    'invisible': Eval('state') != 'failed',
+                    'depends': ['state'],
+                    },
+                })
+
+    @classmethod
+    def default_state(cls):
+        return 'pending'
+
+    @classmethod
+    def default_attempts(cls):
+        return 0
+
+    @classmethod
+    def get_values(cls, kind, application, result=None, classes=None):
+        "Return the values of the notification of the application"
+        return {
+            'kind': kind,
+            'party': application.candidate.party.id,
+            'application': application.id,
+            'result': result,
+            'classes': classes.id if classes else None,
+            'company': application.company.id,
+            'next_attempt': datetime.now(),
+            }
+
+    @classmethod
+    def flush(cls, notifications):
+        "Create the buffered notifications at once and empty the buffer"
+        if notifications:
+            cls.create(notifications)
+            del notifications[:]
+
+    def get_message(self):
+        subject, body = MESSAGES[self.kind]
+        return subject, body.format(
+            name=self.party.name,
+            course=self.application.course.name if self.application else '',
+            result=self.result or '',
+            classes=self.classes.rec_name if self.classes else '')
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, notifications):
+        cls.write(notifications, {
+                'state': 'pending',
+                'attempts': 0,
+                'next_attempt': datetime.now(),
+                })
+
+    @classmethod
+    def drain(cls):
+        "Send a batch of the pending notifications at the configured rate"
+        batch = config.getint(
+            'akademy_matriculation', 'notification_batch', default=100)
+        rate = config.getfloat(
+            'akademy_matriculation', 'notification_rate', default=10)
+        now = datetime.now()
+
+        notifications = cls.search([
+            ('state', '=', 'pending'),
+            ('next_attempt', '<=', now),
+            ], order=[('next_attempt', 'ASC'), ('id', 'ASC')], limit=batch)
+        if not notifications:
+            return
+
+        with get_sender() as sender:
+            for notification_id in [n.id for n in notifications]:
+                start = time.monotonic()
+                # Each notification is locked and committed on its own so
+                # that a failure does not send again those already sent
+                try:
+                    with Transaction().new_transaction():
+                        cls(notification_id).send(sender)
+                except DatabaseOperationalError:
+                    # Sent by a concurrent run of the cron
+                    logger.info("notification %s is locked", notification_id)
+                    continue
+                if rate > 0:
+                    time.sleep(max(
+                            1 / rate - (time.monotonic() - start), 0))
+
+    def send(self, sender):
+        "Send the notification if it is still pending and store the outcome"
+        max_attempts = config.getint(
+            'akademy_matriculation', 'notification_attempts', default=5)
+        self.lock([self])
+        if self.state != 'pending':
+            return
+        try:
+            email = self.party.email
+            if not email:
+                raise ValueError("O destinatário não tem email.")
+            sender.send(email, *self.get_message())
+        except Exception as exception:
+            attempts = self.attempts + 1
+            logger.warning("notification %s failed",
+                self.id, exc_info=True)
+            self.write([self], {
+                    'attempts': attempts,
+                    'message': str(exception),
+                    'state': ('failed' if attempts >= max_attempts
+                        else 'pending'),
+                    'next_attempt': datetime.now() + timedelta(
+                        minutes=2 ** attempts),
+                    })
+            outcome = 'error'
+        else:
+            self.write([self], {
+                    'state': 'sent',
+                    'sent': datetime.now(),
+                    'message': None,
+                    })
+            outcome = 'sent'
+        metrics.inc('akademy_notifications_total',
+            kind=self.kind, outcome=outcome)
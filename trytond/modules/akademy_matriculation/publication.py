@@ -0,0 +1,95 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from sql.functions import CurrentTimestamp
+
+from trytond.model import Index, ModelSQL, ModelView, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+
+class ApplicationsResultSnapshot(ModelSQL, ModelView):
+    'Applications Result Snapshot'
+    __name__ = 'akademy_matriculation.applications.result.snapshot'
+
+    phase = fields.Many2One('akademy_configuration.phase', 'Fase',
+        required=True, readonly=True, ondelete="CASCADE")
+    application = fields.Integer('Candidatura', required=True, readonly=True)
+    candidate_code = fields.Char('Código do candidato', readonly=True)
+    candidate_name = fields.Char('Candidato', readonly=True)
+    course = fields.Char('Curso', readonly=True)
+    application_criteria = fields.Char('Critério de admissão', readonly=True)
+    result = fields.Char('Resultado', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(ApplicationsResultSnapshot, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_indexes.update({
+            Index(table, (table.candidate_code, Index.Equality())),
+            Index(table, (table.application, Index.Equality())),
+        })
+        cls._order = [('candidate_name', 'ASC')]
+
+    @classmethod
+    def publish(cls, phases):
+        "Replace the published results of the phases by the current ones"
+        pool = Pool()
+        Result = pool.get('akademy_matriculation.applications.result')
+        Applications = pool.get('akademy_matriculation.applications')
+        Candidates = pool.get('akademy_matriculation.candidates')
+        Criteria = pool.get('akademy_configuration.application.criteria')
+        Course = pool.get('akademy_configuration.course')
+        Party = pool.get('party.party')
+        snapshot = cls.__table__()
+        result = Result.__table__()
+        application = Applications.__table__()
+        candidate = Candidates.__table__()
+        criteria = Criteria.__table__()
+        course = Course.__table__()
+        party = Party.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        phase_ids = [p.id for p in phases]
+        cursor.execute(*snapshot.delete(
+                where=snapshot.phase.in_(phase_ids)))
+
+        query = result.join(application,
+            condition=result.application == application.id
+            ).join(candidate, condition=application.candidate == candidate.id
+            ).join(party, condition=candidate.party == party.id
+            ).join(course, condition=application.course == course.id
+            ).join(criteria,
+                condition=result.application_criteria == criteria.id
+            ).select(
+                transaction.user, CurrentTimestamp(),
+                result.phase, application.id, candidate.code, party.name,
+                course.name, criteria.name, result.result,
+                where=result.phase.in_(phase_ids))
+        cursor.execute(*snapshot.insert(
+                columns=[
+                    snapshot.create_uid, snapshot.create_date,
+                    snapshot.phase, snapshot.application,
+                    snapshot.candidate_code, snapshot.candidate_name,
+                    snapshot.course, snapshot.application_criteria,
+                    snapshot.result],
+                values=query))
+
+    @classmethod
+    def lookup(cls, candidate_code=None, application=None):
+        "Return the published results of the candidate or application"
+        snapshot = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        columns = ['application', 'course', 'application_criteria', 'result']
+        if application is not None:
+            # The ids are sequential so they must not disclose the candidate
+            where = snapshot.application == application
+        else:
+            where = snapshot.candidate_code == candidate_code
+            columns[1:1] = ['candidate_code', 'candidate_name']
+        cursor.execute(*snapshot.select(
+                *[getattr(snapshot, c) for c in columns],
+                where=where, order_by=[snapshot.application.asc]))
+        return [dict(zip(columns, row)) for row in cursor]
@@ -0,0 +1,119 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Read the reports and exports of the module from a replica database
+
+The replica is another database name of the server, like a streaming
+replica published under its own name by the connection pooler. It is
+used only while its lag stays below replica_max_lag seconds, otherwise
+the reads stay on the primary.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from trytond import backend
+from trytond.config import config
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+_lags = {}
+
+
+def get_lag(database_name):
+    "Return the replication lag of the database in seconds or None"
+    interval = config.getint(
+        'akademy_matriculation', 'replica_check_interval', default=10)
+    now = time.monotonic()
+    checked, lag = _lags.get(database_name, (None, None))
+    if checked is not None and now - checked < interval:
+        return lag
+    lag = None
+    try:
+        database = backend.Database(database_name).connect()
+        connection = database.get_connection(readonly=True)
+        try:
+            cursor = connection.cursor()
+            if backend.name == 'postgresql':
+                # Without pending WAL the replica is up to date even if the
+                # primary has not written for a while
+                cursor.execute("SELECT CASE "
+                    "WHEN NOT pg_is_in_recovery() THEN 0 "
+                    "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+                    "THEN 0 "
+                    "ELSE EXTRACT(EPOCH FROM "
+                    "NOW() - pg_last_xact_replay_timestamp()) END")
+                lag, = cursor.fetchone()
+                lag = float(lag) if lag is not None else None
+            else:
+                lag = 0
+        finally:
+            database.put_connection(connection)
+    except Exception:
+        logger.warning("replica %s is not available", database_name,
+            exc_info=True)
+    _lags[database_name] = (now, lag)
+    return lag
+
+
+def get_database(database_name):
+    "Return the replica to read from or database_name when it lags"
+    replica = config.get(
+        'akademy_matriculation', 'replica_database', default='')
+    if not replica or replica == database_name:
+        return database_name
+    max_lag = config.getfloat(
+        'akademy_matriculation', 'replica_max_lag', default=30)
+    lag = get_lag(replica)
+    if lag is None or lag > max_lag:
+        metrics.inc('akademy_replica_reads_total', database='primary')
+        return database_name
+    metrics.inc('akademy_replica_reads_total', database='replica')
+    return replica
+
+
+def init_pool(database_name):
+    pool = Pool(database_name)
+    if database_name not in Pool.database_list():
+        with Transaction(new=True).start(database_name, 0, readonly=True):
+            pool.init()
+    return pool
+
+
+@contextmanager
+def read_transaction():
+    "Run the block in a read-only transaction of the replica if fresh enough"
+    transaction = Transaction()
+    database_name = get_database(transaction.database.name)
+    if database_name == transaction.database.name:
+        yield transaction
+        return
+    init_pool(database_name)
+    with Transaction(new=True).start(database_name, transaction.user,
+            readonly=True, context=transaction.context) as replica:
+        yield replica
+
+
+class ReplicaReadMixin(object):
+    "Export the records from the replica"
+
+    @classmethod
+    def export_data(cls, records, fields_names, header=False):
+        with read_transaction():
+            Model = Pool().get(cls.__name__)
+            return super(ReplicaReadMixin, Model).export_data(
+                Model.browse(list(map(int, records))), fields_names,
+                header=header)
+
+    @classmethod
+    def export_data_domain(cls, domain, fields_names, offset=0, limit=None,
+            order=None, header=False):
+        with read_transaction():
+            Model = Pool().get(cls.__name__)
+            return super(ReplicaReadMixin, Model).export_data_domain(
+                domain, fields_names, offset=offset, limit=limit,
+                order=order, header=header)
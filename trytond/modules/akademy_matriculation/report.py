@@ -1,12 +1,52 @@
 # This file is part of SAGE Education.   The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
 
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from trytond.config import config
+from trytond.exceptions import UserError
+from trytond.model import ModelView, fields
 from trytond.pool import Pool
 from trytond.report import Report
+from trytond.tools import grouped_slice
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
 from datetime import date
 
+from . import metrics
+from .replica import get_database, init_pool, read_transaction
 
-class ApplicationCriteriaReport(Report):
+BATCH_PRINT_REPORTS = {
+    'akademy_matriculation.student.transfer': [
+        ('akademy_report.student.transfer.report', 'Transferência externa'),
+        ('akademy_report.student.transfer.internal.report',
+            'Transferência interna'),
+        ('akademy_report.equivalence.discipline.report',
+            'Gerar equivalência'),
+        ],
+    'akademy_matriculation.candidates': [
+        ('akademy_report.candidates.report', 'Ficha do candidato'),
+        ],
+    }
+
+
+class ArchivedReportMixin(object):
+    "Read the matriculation data of archived lective years too"
+
+    @classmethod
+    @metrics.timed('akademy_report_seconds')
+    def execute(cls, ids, data):
+        # Long reports read from the replica to not slow down the desks
+        with read_transaction() as transaction, \
+                transaction.set_context(active_test=False):
+            Report = Pool().get(cls.__name__, type='report')
+            return super(ArchivedReportMixin, Report).execute(ids, data)
+
+
+class ApplicationCriteriaReport(ArchivedReportMixin, Report):
     __name__ = 'akademy_report.application.criteria.report'
 
     @classmethod
@@ -22,7 +62,7 @@ class ApplicationCriteriaReport(Report):
         return context
 
 
-class CandidatesReport(Report):
+class CandidatesReport(ArchivedReportMixin, Report):
 	__name__ = 'akademy_report.candidates.report'
 
 	@classmethod
@@ -37,7 +77,7 @@ class CandidatesReport(Report):
 		return context
 
 
-class ApplicationResultReport(Report):
+class ApplicationResultReport(ArchivedReportMixin, Report):
 	__name__ = 'akademy_report.application.result.report'
 
 	@classmethod
@@ -54,7 +94,7 @@ class ApplicationResultReport(Report):
 		return context
 
 
-class StudentTransferReport(Report):
+class StudentTransferReport(ArchivedReportMixin, Report):
 	__name__ = 'akademy_report.student.transfer.report'
 
 	@classmethod
@@ -69,7 +109,7 @@ class StudentTransferReport(Report):
 		return context
 
 
-class StudentTransferInternalReport(Report):
+class StudentTransferInternalReport(ArchivedReportMixin, Report):
 	__name__ = 'akademy_report.student.transfer.internal.report'
 
 	@classmethod
@@ -84,7 +124,7 @@ class StudentTransferInternalReport(Report):
 		return context
 
 
-class EquivalenceDisciplineReport(Report):
+class EquivalenceDisciplineReport(ArchivedReportMixin, Report):
 	__name__ = 'akademy_report.equivalence.discipline.report'
 
 	@classmethod
@@ -170,3 +210,99 @@ class EquivalenceDisciplineReport(Report):
 		
 		return [student, discipline]
 
+
+class BatchPrintStart(ModelView):
+    'Batch Print Start'
+    __name__ = 'akademy_matriculation.batch.print.start'
+
+    report = fields.Selection('get_reports', 'Documento', required=True)
+    chunk_size = fields.Integer('Registos por documento', required=True,
+        domain=[('chunk_size', '>', 0)],
+        help="Número de registos impressos em cada documento.")
+
+    @classmethod
+    def get_reports(cls):
+        model = Transaction().context.get('active_model')
+        return BATCH_PRINT_REPORTS.get(model, [])
+
+    @classmethod
+    def default_chunk_size(cls):
+        return 1
+
+
+class BatchPrintResult(ModelView):
+    'Batch Print Result'
+    __name__ = 'akademy_matriculation.batch.print.result'
+
+    file = fields.Binary('Ficheiro', filename='filename', readonly=True)
+    filename = fields.Char('Nome do ficheiro', readonly=True)
+
+
+class BatchPrint(Wizard):
+    'Batch Print'
+    __name__ = 'akademy_matriculation.batch.print'
+
+    start_state = 'start'
+    start = StateView(
+        'akademy_matriculation.batch.print.start',
+        "akademy_matriculation.batch_print_start_view_form", [
+            Button(string=u'Cancelar', state='end', icon='tryton-cancel'),
+            Button(string=u'Imprimir', state='render', icon='tryton-print',
+                default=True)
+        ]
+    )
+    render = StateTransition()
+    result = StateView(
+        'akademy_matriculation.batch.print.result',
+        "akademy_matriculation.batch_print_result_view_form", [
+            Button(string=u'Fechar', state='end', icon='tryton-close')
+        ]
+    )
+
+    @metrics.timed('akademy_wizard_seconds')
+    def transition_render(self):
+        if not self.start.chunk_size or self.start.chunk_size < 1:
+            raise UserError("Não foi possível imprimir os documentos, "
+                "porque o número de registos por documento deve ser maior que 0.")
+        transaction = Transaction()
+        database_name = get_database(transaction.database.name)
+        init_pool(database_name)
+        workers = config.getint('akademy_matriculation', 'print_workers',
+            default=os.cpu_count() or 1)
+        chunks = [list(c) for c in grouped_slice(
+                sorted(r.id for r in self.records), self.start.chunk_size)]
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            documents = list(executor.map(
+                    lambda ids: self.render_chunk(
+                        database_name, transaction.user,
+                        transaction.context, self.start.report, ids),
+                    chunks))
+
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for i, (ext, content, _, name) in enumerate(documents, 1):
+                archive.writestr('%s-%04d.%s' % (name, i, ext), content)
+        self.result.file = data.getvalue()
+        self.result.filename = '%s.zip' % documents[0][3] if documents else None
+        return 'result'
+
+    @classmethod
+    def render_chunk(cls, database_name, user, context, report_name, ids):
+        "Render the report of ids in its own transaction"
+        # Each thread renders and converts its document on its own
+        # connection, so the conversions run side by side
+        with Transaction().start(database_name, user, readonly=True,
+                context=context):
+            Report = Pool().get(report_name, type='report')
+            return Report.execute(ids, {
+                    'model': Transaction().context.get('active_model'),
+                    'id': ids[0],
+                    'ids': ids,
+                    })
+
+    def default_result(self, fields):
+        return {
+            'file': self.result.file,
+            'filename': self.result.filename,
+            }
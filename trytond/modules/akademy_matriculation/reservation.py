@@ -0,0 +1,112 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from datetime import datetime, timedelta
+
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool
+
+from .allocation import ClasseAllocator
+
+sel_reservation_state = [
+    ('held', 'Reservada'),
+    ('consumed', 'Utilizada'),
+    ('released', 'Libertada'),
+]
+
+
+class SeatReservation(ModelSQL, ModelView):
+    'Seat Reservation'
+    __name__ = 'akademy_matriculation.seat.reservation'
+
+    application_result = fields.Many2One(
+        'akademy_matriculation.applications.result', 'Resultado',
+        required=True, ondelete="CASCADE",
+        help="Resultado de admissão que reservou a vaga.")
+    classes = fields.Many2One('akademy_classe.classes', 'Turma',
+        required=True, ondelete="CASCADE",
+        help="Turma onde a vaga está reservada.")
+    expiration = fields.DateTime('Expira em', required=True,
+        help="Data e hora até à qual a vaga fica reservada.")
+    state = fields.Selection(sel_reservation_state, 'Estado',
+        required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(SeatReservation, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints = [
+            ('key', Unique(table, table.application_result),
+            u'Já existe uma vaga reservada para este resultado de admissão.')
+        ]
+        cls._sql_indexes.update({
+            Index(table,
+                (table.classes, Index.Equality()),
+                (table.expiration, Index.Range()),
+                where=table.state == 'held'),
+        })
+        cls._order = [('expiration', 'ASC')]
+
+    @classmethod
+    def default_state(cls):
+        return 'held'
+
+    def get_rec_name(self, name):
+        return self.application_result.rec_name
+
+    @classmethod
+    def hold(cls, results):
+        "Reserve a class seat for each admitted result"
+        pool = Pool()
+        Classes = pool.get('akademy_classe.classes')
+
+        reservations = []
+        allocators = {}
+        for result in results:
+            if result.result != 'Admitido':
+                continue
+            application = result.application
+            key = (application.lective_year.id,
+                application.course_classe.classe.id, application.course.id)
+            if key not in allocators:
+                allocators[key] = ClasseAllocator(Classes.search([
+                    ('lective_year', '=', application.lective_year),
+                    ('classe', '=', application.course_classe.classe),
+                    ('studyplan.course', '=', application.course),
+                    ]))
+            classes = allocators[key].allocate()
+            if classes:
+                days = application.phase.seat_hold_days or 0
+                reservations.append({
+                    'application_result': result.id,
+                    'classes': classes.id,
+                    'expiration': datetime.now() + timedelta(days=days),
+                    })
+        if reservations:
+            return cls.create(reservations)
+        return []
+
+    @classmethod
+    def get_held(cls, application):
+        "Return the valid reservation of the application"
+        reservations = cls.search([
+            ('application_result.application', '=', application),
+            ('state', '=', 'held'),
+            ('expiration', '>', datetime.now()),
+            ], limit=1)
+        if reservations:
+            return reservations[0]
+
+    @classmethod
+    def consume(cls, reservations):
+        cls.write(reservations, {'state': 'consumed'})
+
+    @classmethod
+    def release_expired(cls):
+        "Release in bulk the reservations which have expired"
+        reservations = cls.search([
+            ('state', '=', 'held'),
+            ('expiration', '<=', datetime.now()),
+            ])
+        if reservations:
+            cls.write(reservations, {'state': 'released'})
@@ -0,0 +1,54 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+import hashlib
+import json
+
+from trytond.config import config
+from trytond.protocols.wrappers import (
+    HTTPStatus, Response, abort, with_pool, with_transaction)
+from trytond.wsgi import app
+
+from . import metrics
+
+
+def _results_response(request, results):
+    if not results:
+        abort(HTTPStatus.NOT_FOUND)
+    body = json.dumps(results, sort_keys=True).encode('utf-8')
+    response = Response(body, mimetype='application/json')
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    response.headers['Cache-Control'] = 'public, max-age=60'
+    return response.make_conditional(request)
+
+
+@app.route(
+    '/<database_name>/akademy_matriculation/result/candidate/<code>',
+    methods=['GET'])
+@with_pool
+@with_transaction(readonly=True)
+def candidate_result(request, pool, code):
+    Snapshot = pool.get('akademy_matriculation.applications.result.snapshot')
+    return _results_response(request, Snapshot.lookup(candidate_code=code))
+
+
+@app.route(
+    '/<database_name>/akademy_matriculation/result/application/'
+    '<int:application>',
+    methods=['GET'])
+@with_pool
+@with_transaction(readonly=True)
+def application_result(request, pool, application):
+    Snapshot = pool.get('akademy_matriculation.applications.result.snapshot')
+    return _results_response(
+        request, Snapshot.lookup(application=application))
+
+
+@app.route('/akademy_matriculation/metrics', methods=['GET'])
+def metrics_exposition(request):
+    hosts = config.get('akademy_matriculation', 'metrics_hosts',
+        default='127.0.0.1,::1')
+    if request.remote_addr not in [h.strip() for h in hosts.split(',')]:
+        abort(HTTPStatus.FORBIDDEN)
+    return Response(metrics.render(),
+        mimetype='text/plain; version=0.0.4; charset=utf-8')
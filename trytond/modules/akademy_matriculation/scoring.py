@@ -0,0 +1,62 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+"""Score the applications of an admission criteria
+
+score = average + bonus of the reference
+    - penalty * (years of age over the threshold)
+
+The columns of all the applications are scored at once with NumPy when it
+is installed, otherwise with a loop giving the same scores.
+"""
+
+from datetime import date
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def date_key(value):
+    "Return the date as the YYYYMMDD integer whose difference gives the age"
+    return value.year * 10000 + value.month * 100 + value.day
+
+
+def compute(averages, births, references, bonuses=None, threshold=None,
+        penalty=0, today=None):
+    """Return the scores rounded to 2 digits
+
+    births are YYYYMMDD integers or None, references are ids or None and
+    bonuses maps a reference id to its bonus.
+    """
+    bonuses = bonuses or {}
+    today = date_key(today or date.today())
+    penalty = float(penalty or 0)
+    if threshold is None:
+        penalty = 0
+    if numpy is None:
+        return _compute_python(
+            averages, births, references, bonuses, threshold, penalty, today)
+
+    scores = numpy.array(averages, dtype=float)
+    references = numpy.array(
+        [-1 if r is None else r for r in references], dtype=numpy.int64)
+    for reference, bonus in bonuses.items():
+        scores[references == reference] += float(bonus)
+    if penalty:
+        births = numpy.array(births, dtype=float)
+        ages = numpy.floor((today - births) / 10000)
+        over = numpy.nan_to_num(numpy.maximum(ages - threshold, 0))
+        scores -= penalty * over
+    return numpy.round(scores, 2).tolist()
+
+
+def _compute_python(
+        averages, births, references, bonuses, threshold, penalty, today):
+    scores = []
+    for average, birth, reference in zip(averages, births, references):
+        score = float(average) + float(bonuses.get(reference, 0))
+        if penalty and birth is not None:
+            score -= penalty * max((today - birth) // 10000 - threshold, 0)
+        scores.append(round(score, 2))
+    return scores
@@ -1,5 +1,44 @@
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 
+import socketserver
+import threading
+from datetime import date
+from unittest.mock import patch
+
+from trytond.config import config
+
+from .. import metrics, replica, scoring
+from ..allocation import QuotaAllocator, scale_seats
+from ..notification import SMTPSender
+from ..tools import blocking_key
+from ..waitlist import next_positions, vacancies, withdrawal_refusal
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    "Accept the messages like an SMTP server and keep them in memory"
+    messages = []
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode().strip()
+            command = line[:4].upper()
+            if not line or command == 'QUIT':
+                self.reply('221 bye')
+                break
+            elif command == 'DATA':
+                self.reply('354 end with .')
+                data = []
+                for line in iter(self.rfile.readline, b'.\r\n'):
+                    data.append(line.decode())
+                self.messages.append(''.join(data))
+                self.reply('250 queued')
+            else:
+                self.reply('250 ok')
+
+
 class MatriculationTestCase(ModuleTestCase):
     "Matriculation Test Case"
     module = 'akademy_matriculation'
@@ -9,4 +48,137 @@ class MatriculationTestCase(ModuleTestCase):
         "Test method"
         self.assertTrue(True)
 
+    def test_blocking_key(self):
+        "Test blocking key of spelling variations"
+        self.assertEqual(
+            blocking_key('José da Silva', None),
+            blocking_key('Jose Sylva', None))
+        self.assertEqual(
+            blocking_key('Filipe Nhanga', None),
+            blocking_key('Philipe Nyanga', None))
+        self.assertNotEqual(
+            blocking_key('José da Silva', None),
+            blocking_key('João da Silva', None))
+        self.assertIsNone(blocking_key('', None))
+
+    def test_metrics_render(self):
+        "Test metrics of several threads are summed"
+        def record():
+            metrics.inc('test_total', model='test')
+            metrics.observe('test_seconds', 0.2, model='test')
+        threads = [threading.Thread(target=record) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        output = metrics.render()
+        self.assertIn('# TYPE test_total counter', output)
+        self.assertIn('test_total{model="test"} 3', output)
+        self.assertIn('test_seconds_bucket{model="test",le="0.25"} 3', output)
+        self.assertIn('test_seconds_count{model="test"} 3', output)
+
+    def test_smtp_sender(self):
+        "Test the notifications are delivered to the SMTP server"
+        server = socketserver.TCPServer(('localhost', 0), SMTPStandIn)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            uri = 'smtp://localhost:%s' % server.server_address[1]
+            with SMTPSender(uri) as sender:
+                sender.send('candidate@example.com',
+                    "Resultado da candidatura", "Admitido")
+                sender.send('other@example.com',
+                    "Resultado da candidatura", "Não admitido")
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(len(SMTPStandIn.messages), 2)
+        self.assertIn('To: candidate@example.com', SMTPStandIn.messages[0])
+        self.assertIn('Subject: Resultado da candidatura',
+            SMTPStandIn.messages[0])
+
+    def test_replica_fallback(self):
+        "Test the reads fall back to the primary when the replica lags"
+        if not config.has_section('akademy_matriculation'):
+            config.add_section('akademy_matriculation')
+        self.assertEqual(replica.get_database('primary'), 'primary')
+
+        config.set('akademy_matriculation', 'replica_database', 'replica')
+        config.set('akademy_matriculation', 'replica_max_lag', '30')
+        try:
+            for lag, database in [
+                    (0, 'replica'), (29.5, 'replica'),
+                    (31, 'primary'), (None, 'primary')]:
+                with patch.object(replica, 'get_lag', return_value=lag):
+                    self.assertEqual(
+                        replica.get_database('primary'), database)
+            self.assertEqual(replica.get_database('replica'), 'replica')
+        finally:
+            config.remove_option('akademy_matriculation', 'replica_database')
+            config.remove_option('akademy_matriculation', 'replica_max_lag')
+
+    def test_scoring(self):
+        "Test the scores with bonuses and the age penalty"
+        args = ([14.5, 12, 18.25, 10],
+            [20050101, None, 19980615, 20070301], [1, 2, None, 1])
+        kwargs = {
+            'bonuses': {1: 1.5, 2: -0.5},
+            'threshold': 18,
+            'penalty': 0.75,
+            'today': date(2026, 10, 19),
+            }
+        self.assertEqual(scoring.compute(*args, **kwargs),
+            [13.75, 11.5, 10.75, 10.75])
+        self.assertEqual(scoring.compute(*args), [14.5, 12, 18.25, 10])
+        self.assertEqual(scoring._compute_python(*args,
+                kwargs['bonuses'], 18, 0.75, scoring.date_key(kwargs['today'])),
+            scoring.compute(*args, **kwargs))
+
+    def test_quota_allocation(self):
+        "Test the quotas are filled by rank and spill over"
+        # Every fourth candidate is Bolseiro (2), no candidate uses quota 3
+        ranked = [(i, 2 if i % 4 == 0 else 1) for i in range(1, 16)]
+        self.assertEqual(
+            QuotaAllocator(10, {2: 3, 3: 2}).allocate(ranked),
+            [1, 2, 3, 4, 5, 6, 7, 8, 9, 12])
+        self.assertEqual(
+            QuotaAllocator(5, {}).allocate(ranked), [1, 2, 3, 4, 5])
+        self.assertEqual(
+            QuotaAllocator(10, {2: 3}, taken={2: 2, 1: 6}).allocate(ranked),
+            [1, 4])
+
+    def test_waitlist_positions(self):
+        "Test the results are appended after the last position of their key"
+        keys = [(1, 10), (1, 10), (2, 10), (1, 11), (1, 10)]
+        self.assertEqual(
+            next_positions(keys, {(1, 10): 4, (2, 10): None}),
+            [5, 6, 1, 1, 7])
+
+    def test_waitlist_vacancies(self):
+        "Test the released seats are counted per key in withdrawal order"
+        self.assertEqual(
+            list(vacancies([(10, 1), (11, 1), (10, 1)]).items()),
+            [((10, 1), 2), ((11, 1), 1)])
+
+    def test_withdrawal_refusal(self):
+        "Test only the admitted results not matriculated can withdraw"
+        self.assertIsNone(withdrawal_refusal('Admitido', []))
+        self.assertIsNone(
+            withdrawal_refusal('Admitido', ['held', 'released']))
+        self.assertEqual(
+            withdrawal_refusal('Admitido', ['consumed']), 'matriculated')
+        self.assertEqual(
+            withdrawal_refusal('Não admitido', []), 'not_admitted')
+
+    def test_scale_seats(self):
+        "Test the reserved seats are scaled within the adjusted limit"
+        self.assertEqual(scale_seats(40, [10, 5], 1.1), (44, [11, 6]))
+        self.assertEqual(scale_seats(1, [0], 0.4), (1, [0]))
+        self.assertEqual(scale_seats(10, [5, 5], 0.25), (2, [1, 1]))
+        self.assertEqual(scale_seats(4, [2, 2], 0.5), (2, [1, 1]))
+        self.assertEqual(scale_seats(3, [3], 0.1), (1, [0]))
+
 del ModuleTestCase
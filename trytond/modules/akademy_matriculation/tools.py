@@ -0,0 +1,91 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+import re
+import unicodedata
+
+from trytond.config import config
+
+# Portuguese spellings which sound the same, applied in order
+_PHONETIC = [
+    ('ph', 'f'), ('ch', 'x'), ('sh', 'x'), ('lh', 'li'), ('nh', 'ni'),
+    ('qu', 'c'), ('gu', 'g'), ('ce', 'se'), ('ci', 'si'), ('h', ''),
+    ('y', 'i'), ('w', 'v'), ('k', 'c'), ('q', 'c'), ('z', 's'),
+]
+
+
+def normalize_name(name):
+    "Return the name in lower case without accents nor punctuation"
+    name = unicodedata.normalize('NFKD', name or '')
+    name = ''.join(c for c in name if not unicodedata.combining(c))
+    return ' '.join(re.findall(r'[a-z]+', name.lower()))
+
+
+def phonetic_key(word):
+    "Return a key shared by the usual spelling variations of word"
+    for spelling, sound in _PHONETIC:
+        word = word.replace(spelling, sound)
+    word = re.sub(r'(.)\1+', r'\1', word)
+    return word[:1] + re.sub(r'[aeiou]', '', word[1:])
+
+
+def blocking_key(name, date_birth):
+    "Return the key of the block of possible duplicates of a person"
+    words = normalize_name(name).split()
+    if not words:
+        return None
+    return (date_birth, phonetic_key(words[0]), phonetic_key(words[-1]))
+
+
+def page_size():
+    return config.getint('akademy_matriculation', 'page_size', default=1000)
+
+
+def iter_pages(Model, domain, size=None, prefetch=None):
+    """Yield the records of Model matching domain by pages ordered by id
+
+    Each page is searched after the last id of the previous one so that
+    only one page is kept in memory. The dotted field names of prefetch
+    are read for the whole page at once.
+    """
+    size = size or page_size()
+    last_id = None
+    while True:
+        page_domain = list(domain)
+        if last_id is not None:
+            page_domain.append(('id', '>', last_id))
+        records = Model.search(page_domain, order=[('id', 'ASC')], limit=size)
+        if not records:
+            break
+        if prefetch:
+            prefetch_fields(records, prefetch)
+        yield records
+        if len(records) < size:
+            break
+        last_id = records[-1].id
+
+
+def iter_ids(Model, domain, size=None):
+    "Yield the ids of Model matching domain in id order"
+    for records in iter_pages(Model, domain, size=size):
+        for record in records:
+            yield record.id
+
+
+def prefetch_fields(records, names):
+    """Read the dotted field names of records with one read per field
+
+    The records of a same list share their cache, so reading a field on
+    them loads it for the whole list.
+    """
+    for name in names:
+        values = list(records)
+        for field in name.split('.'):
+            related = []
+            for value in values:
+                value = getattr(value, field)
+                if isinstance(value, (list, tuple)):
+                    related.extend(value)
+                elif value is not None:
+                    related.append(value)
+            values = related
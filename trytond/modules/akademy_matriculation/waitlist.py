@@ -0,0 +1,143 @@
+# This file is part of SAGE Education.   The COPYRIGHT file at the top level of
+# this repository contains the full copyright notices and license terms.
+
+from sql.aggregate import Max
+
+from trytond.model import Index, ModelSQL, ModelView, Unique, fields
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from . import metrics
+
+sel_waitlist_state = [
+    ('waiting', 'Em espera'),
+    ('promoted', 'Admitido'),
+    ('withdrawn', 'Desistiu'),
+]
+
+
+def next_positions(keys, last):
+    "Return the positions at the end of the waitlist of each key in order"
+    last = dict(last)
+    positions = []
+    for key in keys:
+        last[key] = (last.get(key) or 0) + 1
+        positions.append(last[key])
+    return positions
+
+
+def vacancies(keys):
+    "Return the number of seats released for each key in the order of keys"
+    result = {}
+    for key in keys:
+        result[key] = result.get(key, 0) + 1
+    return result
+
+
+def withdrawal_refusal(result, reservation_states):
+    "Return why a result with its seat reservations can not withdraw or None"
+    if result != 'Admitido':
+        return 'not_admitted'
+    if 'consumed' in reservation_states:
+        return 'matriculated'
+
+
+class Waitlist(ModelSQL, ModelView):
+    'Waitlist'
+    __name__ = 'akademy_matriculation.waitlist'
+
+    application_criteria = fields.Many2One(
+        'akademy_configuration.application.criteria', 'Critério de admissão',
+        required=True, readonly=True, ondelete="CASCADE")
+    application_result = fields.Many2One(
+        'akademy_matriculation.applications.result', 'Resultado',
+        required=True, readonly=True, ondelete="CASCADE",
+        help="Resultado do candidato que cumpriu o critério sem vaga.")
+    company = fields.Many2One('company.company', 'Escola', readonly=True)
+    position = fields.Integer('Posição', required=True, readonly=True)
+    state = fields.Selection(sel_waitlist_state, 'Estado',
+        required=True, readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(Waitlist, cls).__setup__()
+        table = cls.__table__()
+        cls._sql_constraints = [
+            ('result', Unique(table, table.application_result),
+            u'O resultado já se encontra na lista de espera.'),
+            ('position', Unique(table, table.company,
+                    table.application_criteria, table.position),
+            u'A posição já está ocupada na lista de espera.'),
+        ]
+        cls._sql_indexes.update({
+            Index(table,
+                (table.company, Index.Equality()),
+                (table.application_criteria, Index.Equality()),
+                (table.position, Index.Range()),
+                where=table.state == 'waiting'),
+        })
+        cls._order = [('position', 'ASC')]
+
+    @classmethod
+    def default_state(cls):
+        return 'waiting'
+
+    def get_rec_name(self, name):
+        return self.application_result.rec_name
+
+    @classmethod
+    def append(cls, results):
+        "Put the results at the end of the waitlist of their criteria"
+        Criteria = Pool().get('akademy_configuration.application.criteria')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        # Concurrent evaluations of the criteria append one after the other
+        Criteria.lock(Criteria.browse(sorted(
+                    {r.application_criteria.id for r in results})))
+        keys = [(r.company.id, r.application_criteria.id) for r in results]
+        last = {}
+        for company, criteria in set(keys):
+            cursor.execute(*table.select(Max(table.position),
+                    where=(table.company == company)
+                    & (table.application_criteria == criteria)))
+            last[(company, criteria)] = cursor.fetchone()[0]
+        return cls.create([{
+                    'application_criteria': criteria,
+                    'application_result': result.id,
+                    'company': company,
+                    'position': position,
+                    } for result, (company, criteria), position
+                in zip(results, keys, next_positions(keys, last))])
+
+    @classmethod
+    def promote(cls, criteria, company, quantity=1):
+        "Admit the first waiting results of the criteria and hold their seats"
+        pool = Pool()
+        Criteria = pool.get('akademy_configuration.application.criteria')
+        Result = pool.get('akademy_matriculation.applications.result')
+        SeatReservation = pool.get('akademy_matriculation.seat.reservation')
+        Notification = pool.get('akademy_matriculation.notification')
+
+        # Concurrent withdrawals of the criteria promote one after the other
+        Criteria.lock([criteria])
+        entries = cls.search([
+            ('company', '=', company),
+            ('application_criteria', '=', criteria),
+            ('state', '=', 'waiting'),
+            ], order=[('position', 'ASC')], limit=quantity)
+        if not entries:
+            return []
+
+        results = [e.application_result for e in entries]
+        Result.write(results, {'result': 'Admitido'})
+        cls.write(entries, {'state': 'promoted'})
+        results = Result.browse([r.id for r in results])
+        SeatReservation.hold(results)
+        Notification.flush([
+                Notification.get_values('admission', r.application,
+                    result=r.result)
+                for r in results])
+        metrics.inc('akademy_admissions_total', len(results),
+            model=cls.__name__)
+        return results